@@ -0,0 +1,589 @@
+"""Benchmarks of the calc, query and plot hot paths on synthetic JHU data.
+
+The synthetic data has the shape of the JHU US time series, with
+n_states * n_counties locations and n_days date columns, and is the same
+for the same sizes and seed. Each benchmark reports its best and mean wall
+time over a number of runs and the peak memory allocated by one run, as
+traced by tracemalloc. Results are written as JSON so that two versions can
+be compared with --compare.
+
+    python -m covid_tools.bench --counties 60 --days 1000 -o new.json
+    python -m covid_tools.bench --compare old.json new.json
+"""
+import argparse
+import contextlib
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from covid_tools.const import *
+from covid_tools import calc, instrument, query
+from covid_tools.query import JHU_US_CASES, JHU_US_DEATHS
+
+BENCHMARKS = {}
+
+LIVE_JSON_FIXTURE = json.dumps({
+    'features': [{'attributes': {
+        'Last_Update': 1600000000000, 'Confirmed': 6520000, 'Deaths': 194000,
+    }}],
+}).encode()
+LIVE_HTML_FIXTURE = (
+    '<html><head><title>Layer: ncov_cases (ID: 2)</title></head><body>'
+    + '<p>Query results</p>' * 200
+    + '<table class="ftrTable">'
+    + ''.join(f'<tr><td>{x}:</td><td> {y} </td></tr>' for x, y in [
+        ('OBJECTID', 3), ('Country_Region', 'US'),
+        ('Last update', '9/13/2020 12:26:40 PM'), ('Confirmed', 6520000),
+        ('Deaths', 194000)])
+    + '</table><p>Done</p></body></html>'
+).encode()
+
+
+def synthetic_jhu(n_states=56, n_counties=60, n_days=1000, deaths=False,
+                  seed=0):
+    """A wide time series shaped like the JHU US cases or deaths CSV.
+
+    Cases and deaths made with the same sizes and seed share their locations.
+    Only the deaths have a Population column, as in the JHU files.
+    """
+    rng = np.random.default_rng(seed)
+    n_locations = n_states * n_counties
+    state = np.repeat(np.arange(n_states), n_counties)
+    county = np.tile(np.arange(n_counties), n_states)
+    counties = [f'County {x}-{y}' for x, y in zip(state, county)]
+    states = [f'State {x}' for x in state]
+    df = pd.DataFrame({
+        'UID': 84000000 + state * 1000 + county,
+        'iso2': 'US',
+        'iso3': 'USA',
+        'code3': 840,
+        'FIPS': (state * 1000 + county + 1000).astype('float64'),
+        'Admin2': counties,
+        'Province_State': states,
+        'Country_Region': 'US',
+        'Lat': rng.uniform(25, 49, n_locations).round(8),
+        'Long_': rng.uniform(-124, -67, n_locations).round(8),
+        'Combined_Key': [f'{x}, {y}, US' for x, y in zip(counties, states)],
+    })
+    populations = rng.integers(1000, 1000000, n_locations)
+    if deaths:
+        df[POPULATION] = populations
+    # Cases and deaths come from the same daily rates so they stay related
+    rates = populations[:, np.newaxis] * rng.uniform(
+        1e-5, 1e-3, (n_locations, 1))
+    if deaths:
+        rates = rates * 0.02
+    daily = np.random.default_rng(seed + 1 + deaths).poisson(
+        rates, (n_locations, n_days))
+    dates = pd.date_range('2020-01-22', periods=n_days)
+    date_cols = [f'{x.month}/{x.day}/{x:%y}' for x in dates]
+    values = pd.DataFrame(np.cumsum(daily, axis=1), columns=date_cols)
+    return pd.concat([df, values], axis=1)
+
+
+def write_synthetic_jhu(directory, **kwargs):
+    """Writes synthetic cases and deaths CSVs named like the JHU sources.
+
+    Returns:
+        A dict of the source names to the paths of their CSVs.
+    """
+    paths = {}
+    for name, deaths in ((JHU_US_CASES, False), (JHU_US_DEATHS, True)):
+        paths[name] = os.path.join(directory, name + '.csv')
+        synthetic_jhu(deaths=deaths, **kwargs).to_csv(paths[name],
+                                                      index=False)
+    return paths
+
+
+@contextlib.contextmanager
+def synthetic_sources(directory):
+    """Points the JHU sources at the synthetic CSVs in directory"""
+    saved = {}
+    for name in (JHU_US_CASES, JHU_US_DEATHS):
+        source = query.SOURCES[name]
+        saved[name] = source.csv, source.tidy
+        source.csv = os.path.join(directory, name + '.csv')
+        source.tidy = os.path.join(directory, name + '.tidy.feather')
+    try:
+        yield
+    finally:
+        for name, (csv, tidy) in saved.items():
+            query.SOURCES[name].csv, query.SOURCES[name].tidy = csv, tidy
+
+
+def clear_tidy_cache(directory):
+    for name in os.listdir(directory):
+        if '.tidy.' in name:
+            os.remove(os.path.join(directory, name))
+
+
+def measure(func, repeat=3, setup=None):
+    """Times func and traces the peak memory of one more call.
+
+    Args:
+        func: The function to benchmark, called without arguments.
+        repeat: The number of timed calls.
+        setup: An optional function called before every call, untimed.
+    Returns:
+        A dict with the best and mean seconds and the peak traced MB.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'best': min(times), 'mean': sum(times) / len(times),
+            'peak_mb': peak / 2**20}
+
+
+def benchmark(name):
+    """Registers a function of the bench context as a benchmark"""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class BenchContext:
+    """The synthetic data and settings shared by the benchmarks"""
+
+    def __init__(self, directory, n_states, n_counties, n_days, repeat,
+                 seed=0):
+        self.directory = directory
+        self.sizes = {'states': n_states, 'counties': n_counties,
+                      'days': n_days}
+        self.repeat = repeat
+        self.seed = seed
+        write_synthetic_jhu(directory, n_states=n_states,
+                            n_counties=n_counties, n_days=n_days, seed=seed)
+
+    @functools.cached_property
+    def wide_cases(self):
+        return pd.read_csv(os.path.join(self.directory, JHU_US_CASES+'.csv'))
+
+    @functools.cached_property
+    def wide_deaths(self):
+        return pd.read_csv(os.path.join(self.directory,
+                                        JHU_US_DEATHS+'.csv'))
+
+    @functools.cached_property
+    def tidy(self):
+        with synthetic_sources(self.directory):
+            return query.load_jhu_us()
+
+    @functools.cached_property
+    def county_populations(self):
+        return pd.Series(self.wide_deaths[POPULATION].to_numpy(),
+                         index=self.wide_deaths['Admin2'], dtype='float64')
+
+    def sample_groups(self, n_groups):
+        """The tidy rows of the first n_groups counties, with 10% dropped"""
+        counties = self.tidy[COUNTY].cat.categories[:n_groups]
+        df = self.tidy[self.tidy[COUNTY].isin(counties)]
+        df = df.sample(frac=0.9, random_state=self.seed).sort_index()
+        df = df.reset_index(drop=True)
+        df[COUNTY] = df[COUNTY].cat.remove_unused_categories()
+        return df
+
+    def run(self, func, setup=None, repeat=None):
+        return measure(func, repeat or self.repeat, setup)
+
+
+COMPUTE_COLUMNS = (DATE, CASES, COUNTY, NEW_CASES, NEW_CASES_AVG,
+                   CASES_NORM, NEW_CASES_AVG_NORM)
+
+
+@benchmark('tidy_jhu')
+def bench_tidy_jhu(ctx):
+    return ctx.run(lambda: query.tidy_jhu(ctx.wide_cases, CASES))
+
+
+@benchmark('read_source')
+def bench_read_source(ctx):
+    path = os.path.join(ctx.directory, JHU_US_CASES+'.csv')
+    source = query.SOURCES[JHU_US_CASES]
+    return {
+        'read_csv': ctx.run(lambda: pd.read_csv(path)),
+        'source_read_csv': ctx.run(lambda: source.read_csv(path)),
+    }
+
+
+@benchmark('load_jhu_us')
+def bench_load_jhu_us(ctx):
+    with synthetic_sources(ctx.directory):
+        results = {'cold': ctx.run(
+            query.load_jhu_us, setup=lambda: clear_tidy_cache(ctx.directory))}
+        results['warm'] = ctx.run(query.load_jhu_us)
+    return results
+
+
+@benchmark('iter_jhu_us')
+def bench_iter_jhu_us(ctx):
+    def stream():
+        for _ in query.iter_jhu_us(chunk_rows=500):
+            pass
+    with synthetic_sources(ctx.directory):
+        return ctx.run(stream)
+
+
+@benchmark('group_calc')
+def bench_group_calc(ctx):
+    func = functools.partial(_compute_all_group,
+                             populations=ctx.county_populations)
+    df = ctx.sample_groups(100)
+    return ctx.run(lambda: calc.group_calc(df, func, COUNTY, DATE))
+
+
+def _compute_all_group(df, group, populations):
+    return calc.compute_all(df, DATE, CASES, NEW_CASES, NEW_CASES_AVG,
+                            CASES_NORM, NEW_CASES_AVG_NORM,
+                            populations[group])
+
+
+@benchmark('compute_all_groups')
+def bench_compute_all_groups(ctx):
+    args = COMPUTE_COLUMNS + (ctx.county_populations,)
+    results = {}
+    for fused in (False, True):
+        results['fused' if fused else 'default'] = ctx.run(
+            lambda: calc.compute_all_groups(ctx.tidy, *args, fused=fused))
+    n_jobs = os.cpu_count()
+    results[f'process_{n_jobs}'] = ctx.run(
+        lambda: calc.compute_all_groups(ctx.tidy, *args, executor='process',
+                                        n_jobs=n_jobs))
+    results['process_speedup'] = (results['default']['best']
+                                  / results[f'process_{n_jobs}']['best'])
+    return results
+
+
+@benchmark('compute_all_groups_scaling')
+def bench_compute_all_groups_scaling(ctx):
+    """Time per group should stay flat as the number of groups grows"""
+    args = COMPUTE_COLUMNS + (ctx.county_populations,)
+    n_locations = len(ctx.tidy[COUNTY].cat.categories)
+    results = {}
+    for n_groups in sorted({min(x, n_locations) for x in (10, 100, 1000,
+                                                          n_locations)}):
+        df = ctx.sample_groups(n_groups)
+        result = ctx.run(lambda: calc.compute_all_groups(df, *args))
+        result['per_group_ms'] = result['best'] / n_groups * 1e3
+        results[n_groups] = result
+    return results
+
+
+@benchmark('rolling_update')
+def bench_rolling_update(ctx):
+    args = COMPUTE_COLUMNS + (ctx.county_populations,)
+    last_date = ctx.tidy[DATE].max()
+    df_history = ctx.tidy[ctx.tidy[DATE] < last_date]
+    df_new = ctx.tidy[ctx.tidy[DATE] == last_date]
+    df_computed = calc.compute_all_groups(df_history, *args)
+    states = []
+    return {
+        'compute_all_groups_update': ctx.run(
+            lambda: calc.compute_all_groups_update(df_computed, df_new,
+                                                   *args)),
+        'group_rolling_state_from_history': ctx.run(
+            lambda: calc.GroupRollingState.from_history(df_history, *args)),
+        'group_rolling_state_update': ctx.run(
+            lambda: states[-1].update(df_new),
+            setup=lambda: states.append(
+                calc.GroupRollingState.from_history(df_history, *args))),
+    }
+
+
+@benchmark('combine_groups')
+def bench_combine_groups(ctx):
+    regions = {x: f'Region {i % 10}' for i, x in
+               enumerate(ctx.tidy[COUNTY].cat.categories)}
+    df = ctx.tidy.loc[:, [DATE, COUNTY, CASES, DEATHS]].astype({COUNTY: str})
+    return ctx.run(lambda: calc.combine_groups(df, DATE, COUNTY, regions,
+                                               REGION))
+
+
+@benchmark('fill_missing_date_groups')
+def bench_fill_missing_date_groups(ctx):
+    df = ctx.sample_groups(len(ctx.tidy[COUNTY].cat.categories))
+    return ctx.run(lambda: calc.fill_missing_date_groups(df, DATE, COUNTY))
+
+
+@benchmark('rollup_cube')
+def bench_rollup_cube(ctx):
+    from covid_tools.rollup import RollupCube
+
+    def build():
+        cube = RollupCube.from_jhu(ctx.wide_cases, ctx.wide_deaths)
+        for level in (COUNTY, STATE, NATION):
+            cube.level(level)
+    return ctx.run(build)
+
+
+@benchmark('make_region')
+def bench_make_region(ctx):
+    from covid_tools.data import make_region
+    regions = {x: f'Region {i % 40}' for i, x in
+               enumerate(ctx.tidy[COUNTY].cat.categories)}
+    return ctx.run(lambda: make_region(ctx.tidy, regions,
+                                       ctx.county_populations, DATE, COUNTY,
+                                       CASES))
+
+
+@benchmark('weekday_ratio')
+def bench_weekday_ratio(ctx):
+    from covid_tools.data import weekday_ratio_over_average_groups
+    df = calc.daily_change_groups(ctx.tidy, None, CASES, NEW_CASES, COUNTY)
+    df[NEW_CASES_AVG] = df[NEW_CASES].abs() + 1
+    return ctx.run(lambda: weekday_ratio_over_average_groups(
+        df, NEW_CASES, NEW_CASES_AVG, COUNTY, DATE))
+
+
+def _footprint(df, derived_cols=()):
+    """The memory of a dataframe, and the columns not in the compact dtypes"""
+    usage = df.memory_usage(index=False, deep=True)
+    expected = {COUNTY: DTYPES['label'], STATE: DTYPES['label'],
+                CASES: DTYPES['count'], DEATHS: DTYPES['count']}
+    expected.update(dict.fromkeys(derived_cols, DTYPES['derived']))
+    return {
+        'total_mb': usage.sum() / 2**20,
+        'bytes_per_row': usage.sum() / max(len(df), 1),
+        'columns': {col: {'dtype': str(df[col].dtype),
+                          'mb': usage[col] / 2**20} for col in df.columns},
+        'not_compact': [col for col, dtype in expected.items()
+                        if col in df and df[col].dtype != dtype],
+    }
+
+
+@benchmark('memory_footprint')
+def bench_memory_footprint(ctx):
+    args = COMPUTE_COLUMNS + (ctx.county_populations,)
+    derived_cols = COMPUTE_COLUMNS[3:]
+    results = {'tidy': _footprint(ctx.tidy)}
+    saved = DTYPES['derived']
+    try:
+        for dtype in ('float64', 'float32'):
+            DTYPES['derived'] = dtype
+            df = calc.compute_all_groups(ctx.tidy, *args)
+            results[f'compute_all_groups_{dtype}'] = _footprint(df,
+                                                                derived_cols)
+            if dtype == 'float64':
+                # The nullable dtypes compute_all_groups used to return
+                results['compute_all_groups_nullable'] = _footprint(
+                    df.convert_dtypes())
+            del df
+    finally:
+        DTYPES['derived'] = saved
+    return results
+
+
+@benchmark('result_cache')
+def bench_result_cache(ctx):
+    args = COMPUTE_COLUMNS + (ctx.county_populations,)
+
+    def compute():
+        return calc.compute_all_groups(ctx.tidy, *args, cache=True)
+    results = {
+        'miss': ctx.run(compute, setup=calc.clear_result_cache),
+        'hit': ctx.run(compute, setup=compute),
+        'fingerprint_full': ctx.run(
+            lambda: calc.frame_fingerprint(ctx.tidy)),
+        'fingerprint_repeat': ctx.run(
+            lambda: calc.frame_fingerprint(ctx.tidy, trust_identity=True)),
+    }
+    calc.clear_result_cache()
+    return results
+
+
+@benchmark('instrumentation')
+def bench_instrumentation(ctx):
+    args = COMPUTE_COLUMNS + (ctx.county_populations,)
+
+    def traced():
+        with instrument.tracing():
+            calc.compute_all_groups(ctx.tidy, *args)
+
+    def per_group():
+        calc.group_calc(ctx.tidy, lambda df, group: df, COUNTY)
+
+    def per_group_traced():
+        with instrument.tracing():
+            per_group()
+    return {
+        'compute_all_groups_off': ctx.run(
+            lambda: calc.compute_all_groups(ctx.tidy, *args)),
+        'compute_all_groups_traced': ctx.run(traced),
+        'group_calc_off': ctx.run(per_group),
+        'group_calc_traced': ctx.run(per_group_traced),
+    }
+
+
+@benchmark('plot')
+def bench_plot(ctx):
+    try:
+        from covid_tools import plot
+    except ImportError as e:
+        return {'skipped': repr(e)}
+    df = calc.compute_all_groups(ctx.tidy, *COMPUTE_COLUMNS,
+                                 ctx.county_populations)
+    n_locations = len(ctx.tidy[COUNTY].cat.categories)
+    results = {}
+    for n_groups in sorted({min(x, n_locations) for x in (50, 500, 3000)}):
+        counties = df[COUNTY].cat.categories[:n_groups]
+        df_groups = df[df[COUNTY].isin(counties)]
+        for max_points in (None, 200):
+            def build():
+                plot._payload_cache.clear()
+                return plot.comparative_interactive(
+                    df_groups, DATE, CASES, CASES_NORM, COUNTY, max_points)
+            result = ctx.run(build)
+            result['payload_mb'] = len(build().to_json()) / 2**20
+            results[f'{n_groups}_{max_points or "all"}'] = result
+    return results
+
+
+@benchmark('parse_live')
+def bench_parse_live(ctx):
+    try:
+        from covid_tools import jhu
+    except Exception as e:
+        return {'skipped': repr(e)}
+    return {
+        'html': ctx.run(lambda: jhu.parse_live_html(LIVE_HTML_FIXTURE),
+                        repeat=100),
+        'json': ctx.run(lambda: jhu.parse_live_json(LIVE_JSON_FIXTURE),
+                        repeat=100),
+    }
+
+
+@benchmark('import_time')
+def bench_import_time(ctx):
+    """Wall time to import each module in a fresh interpreter"""
+    results = {}
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    for module in ('query', 'calc', 'population', 'california', 'rollup'):
+        code = ('import time; start = time.perf_counter(); '
+                f'import covid_tools.{module}; '
+                'print(time.perf_counter() - start)')
+        out = subprocess.run([sys.executable, '-c', code], env=env,
+                             capture_output=True, text=True)
+        results[module] = (float(out.stdout) if out.returncode == 0
+                           else out.stderr.strip().splitlines()[-1])
+    return results
+
+
+def environment():
+    try:
+        import pyarrow
+        pyarrow_version = pyarrow.__version__
+    except ImportError:
+        pyarrow_version = None
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'pyarrow': pyarrow_version,
+        'cpus': os.cpu_count(),
+    }
+
+
+def run_benchmarks(names=None, n_states=56, n_counties=60, n_days=1000,
+                   repeat=3, seed=0):
+    """Runs benchmarks on freshly generated synthetic data.
+
+    Args:
+        names: The names of the benchmarks in BENCHMARKS to run, all if None.
+    Returns:
+        A dict of the environment, the sizes and the results by benchmark.
+    """
+    directory = tempfile.mkdtemp(prefix='covid_tools_bench_')
+    try:
+        ctx = BenchContext(directory, n_states, n_counties, n_days, repeat,
+                           seed)
+        results = {}
+        for name in names or BENCHMARKS:
+            results[name] = BENCHMARKS[name](ctx)
+        return {'environment': environment(), 'sizes': ctx.sizes,
+                'repeat': repeat, 'results': results}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _flatten(results, prefix=''):
+    """Maps 'benchmark/variant' paths to their best times"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict) and 'best' in value:
+            flat[prefix + str(key)] = value['best']
+        elif isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}/'))
+    return flat
+
+
+def compare(old, new):
+    """Lists the best times of two result files side by side"""
+    lines = []
+    if old['sizes'] != new['sizes']:
+        lines.append(f"Sizes differ: {old['sizes']} and {new['sizes']}")
+    old, new = _flatten(old['results']), _flatten(new['results'])
+    lines.append(f"{'benchmark':<50} {'old':>9} {'new':>9} {'ratio':>7}")
+    for name in new:
+        if name in old:
+            lines.append(f'{name:<50} {old[name]:>9.4f} {new[name]:>9.4f} '
+                         f'{old[name] / new[name]:>6.2f}x')
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--states', type=int, default=56)
+    parser.add_argument('--counties', type=int, default=60,
+                        help='Counties per state')
+    parser.add_argument('--days', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-b', '--benchmarks', nargs='+',
+                        choices=list(BENCHMARKS),
+                        help='Benchmarks to run, all by default')
+    parser.add_argument('-o', '--output', help='Writes the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compares two result files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            print(compare(json.load(f_old), json.load(f_new)))
+    else:
+        report = json.dumps(run_benchmarks(
+            args.benchmarks, args.states, args.counties, args.days,
+            args.repeat, args.seed), indent=2, default=str)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(report + '\n')
+        else:
+            print(report)
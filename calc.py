@@ -1,7 +1,17 @@
+import collections
+import hashlib
+import math
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 
-from covid_tools.const import DATE
+from covid_tools.const import DATE, DTYPES
+from covid_tools.instrument import stage, traced, warn_caller
+from covid_tools.storage import feather, write_feather_atomic
 
 
 def mapper_to_func(map_obj):
@@ -14,8 +24,75 @@ def mapper_to_func(map_obj):
     return map_func
 
 
+class GroupCalcError(Exception):
+    """A calculation failed on a group while running in a worker process"""
+
+    def __init__(self, group, message):
+        super().__init__(group, message)
+        self.group = group
+        self.message = message
+
+    def __str__(self):
+        return f'Group {self.group!r}: {self.message}'
+
+
+def _to_columns(df):
+    """Reduces a dataframe to its column arrays for sending between processes"""
+    return {col: df[col].array for col in df.columns}
+
+
+def _run_shard(func, columns, group_col, args, kwargs):
+    """Runs func on one batch of groups inside a worker process"""
+    df = pd.DataFrame(columns)
+    try:
+        return _to_columns(func(df, *args, **kwargs))
+    except Exception as e:
+        # Find the group responsible so the error can name it
+        for group, df_group in df.groupby(group_col, sort=False,
+                                          observed=True):
+            try:
+                func(df_group, *args, **kwargs)
+            except Exception as group_e:
+                raise GroupCalcError(group, repr(group_e)) from None
+        raise GroupCalcError(None, repr(e)) from None
+
+
+def _run_sharded(func, df, group_col, sort_col, n_jobs, *args, **kwargs):
+    """Runs a groupwise function over batches of groups in worker processes.
+
+    The groups are split into batches of roughly equal numbers of groups,
+    four per worker, and each batch is sent to a worker as column arrays. The
+    results are put back together in the same order as a serial run.
+
+    Args:
+        func: A module level function taking the dataframe as its first
+            argument followed by args and kwargs, such as compute_all_groups.
+        df: The dataframe to split by group_col.
+        sort_col: The column other than group_col the result is sorted by.
+        n_jobs: The number of worker processes, all cores if None.
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    df = df[df[group_col].notna()]
+    codes, groups = pd.factorize(df[group_col])
+    n_batches = min(len(groups), 4 * n_jobs)
+    order = np.argsort(codes, kind='stable')
+    group_bounds = np.searchsorted(
+        codes[order], np.arange(n_batches + 1) * len(groups) // n_batches)
+    with ProcessPoolExecutor(n_jobs) as executor:
+        futures = [
+            executor.submit(
+                _run_shard, func,
+                _to_columns(df.take(order[start:end])), group_col, args,
+                kwargs)
+            for start, end in zip(group_bounds[:-1], group_bounds[1:])
+        ]
+        results = [pd.DataFrame(x.result()) for x in futures]
+    return _restore_group_order(pd.concat(results), sort_col, group_col)
+
+
+@traced('group_calc')
 def group_calc(df, single_group_func, group_col, sort_col=None,
-               exclude_groups=None):
+               exclude_groups=None, executor=None, n_jobs=None):
     """Performs a general function on a dataframe with distinct subsets.
 
     In a tidy, time series dataframe with multiple groups, say states, age
@@ -39,6 +116,13 @@ def group_calc(df, single_group_func, group_col, sort_col=None,
         sort_col: An optional argument identifying the column by which to sort
             the dataframe once the individual groups are combined.
         exclude_groups: A list of groups to exclude from the calculations.
+        executor: None to run in this process, or 'process' to spread batches
+            of groups over a pool of worker processes. single_group_func must
+            then be picklable, such as a module level function or a
+            functools.partial of one, and errors are raised as GroupCalcError
+            naming the failing group. The other *_groups functions of this
+            module accept executor and n_jobs with the same meaning.
+        n_jobs: The number of worker processes, all cores if None.
     Returns:
         A copy of the original dataframe where the single_group_func is applied
         to each group. Depending on the function, this may add additional
@@ -46,42 +130,142 @@ def group_calc(df, single_group_func, group_col, sort_col=None,
     """
     if exclude_groups is None:
         exclude_groups = []
+    df = df[~df[group_col].isin(exclude_groups)]
+    if executor == 'process':
+        return _run_sharded(group_calc, df, group_col, sort_col, n_jobs,
+                            single_group_func, group_col, sort_col)
     indiv_groups = []
-    for group in df[group_col].unique():
-        if group in exclude_groups:
-            continue
-        df_group = df[df[group_col] == group]
-        indiv_groups.append(single_group_func(df_group, group))
+    for group, df_group in df.groupby(group_col, sort=False, observed=True):
+        with stage('group_calc.group', group=group, rows_in=len(df_group)):
+            indiv_groups.append(single_group_func(df_group, group))
     sort_list = group_col if sort_col is None else [sort_col, group_col]
     df = pd.concat(indiv_groups).sort_values(sort_list)
     return df[df[group_col].notna()].reset_index(drop=True).copy()
 
 
+def _group_positions(df, group_col):
+    """Position of each row within its group for a group-contiguous frame"""
+    codes = pd.factorize(df[group_col])[0]
+    n_rows = len(codes)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    return np.arange(n_rows) - np.repeat(starts, np.diff(np.r_[starts, n_rows]))
+
+
+def _sort_groups(df, group_col, sort_col=None, exclude_groups=None):
+    """Partitions a dataframe into contiguous groups in a single sort.
+
+    Returns:
+        A tuple of the sorted dataframe, with excluded and null groups
+        removed, and an array with the position of each row in its group.
+    """
+    mask = df[group_col].notna()
+    if exclude_groups:
+        mask &= ~df[group_col].isin(exclude_groups)
+    sort_list = group_col if sort_col is None else [group_col, sort_col]
+    df = df[mask].sort_values(sort_list, kind='mergesort')
+    df = df.reset_index(drop=True)
+    return df, _group_positions(df, group_col)
+
+
+def _rolling_mean_by_group(values, positions, window):
+    """Rolling mean over every group at once.
+
+    The windows are computed over the whole column in one pass, and windows
+    which reach back across a group boundary are masked out.
+    """
+    rolling = pd.Series(values, dtype='float64').rolling(window).mean()
+    rolling = rolling.to_numpy(copy=True)
+    rolling[positions < window - 1] = np.nan
+    return rolling
+
+
+def _restore_group_order(df, date_col, group_col):
+    """Puts a group-contiguous frame back in the order of group_calc"""
+    sort_list = group_col if date_col is None else [date_col, group_col]
+    return df.sort_values(sort_list).reset_index(drop=True)
+
+
+def _restore_int_dtypes(df, dtypes):
+    """Casts columns back to their integer dtypes once filling left no gaps.
+
+    Reindexing turns integer counts into floats to hold the new missing rows,
+    which forward filling then removes.
+    """
+    restore = {col: dtype for col, dtype in dtypes.items()
+               if col in df and pd.api.types.is_integer_dtype(dtype)
+               and df[col].dtype != dtype and df[col].notna().all()}
+    return df.astype(restore) if restore else df
+
+
 def fill_missing_date(df, date_col, ffill_missing=True):
     """Identifies and fills missing days"""
+    dtypes = df.dtypes
     try:
         df = pd.merge(
             pd.DataFrame(
                 index=pd.date_range(df[date_col].min(), df[date_col].max(),
                                     name=date_col)
             ).reset_index(), df, 'left', on=date_col
-        ).copy()
+        )
     except ValueError:
         print(f'Value Error on:\n{df}')
     if ffill_missing:
-        df = df.ffill().copy()
+        df = _restore_int_dtypes(df.ffill(), dtypes)
     return df
 
 
 def fill_missing_date_groups(df, date_col, group_col, exclude_groups=None,
-                             ffill_missing=True):
-    """Fills missing date rows for dataframe with multiple groups."""
+                             ffill_missing=True, executor=None, n_jobs=None):
+    """Fills missing date rows for dataframe with multiple groups.
+
+    The (group, date) index is built once as a product of the groups and the
+    dates, trimmed to the span of dates of each group, and the whole dataframe
+    is reindexed in a single call. Forward filling is done within each group
+    and never carries values from one group into the next.
+    """
+    if executor == 'process':
+        return _run_sharded(fill_missing_date_groups, df, group_col, date_col,
+                            n_jobs, date_col, group_col, exclude_groups,
+                            ffill_missing)
+    mask = df[group_col].notna()
+    if exclude_groups:
+        mask &= ~df[group_col].isin(exclude_groups)
+    df = df[mask]
+    columns = [date_col] + [x for x in df.columns if x != date_col]
+    indexed = df.set_index([group_col, date_col])
+    if not indexed.index.is_unique:
+        return _fill_missing_date_groups_merge(df, date_col, group_col,
+                                               ffill_missing)
+    df = indexed
+
+    group_dates = df.index.get_level_values(date_col)
+    spans = group_dates.to_series().groupby(
+        df.index.get_level_values(group_col), sort=False, observed=True
+    ).agg(['min', 'max'])
+    dates = pd.date_range(spans['min'].min(), spans['max'].max(),
+                          name=date_col)
+    product = pd.MultiIndex.from_product([spans.index, dates],
+                                         names=[group_col, date_col])
+    span_group = np.repeat(np.arange(len(spans)), len(dates))
+    product_dates = product.get_level_values(date_col)
+    in_span = ((product_dates >= spans['min'].to_numpy()[span_group])
+               & (product_dates <= spans['max'].to_numpy()[span_group]))
+    dtypes = df.dtypes
+    df = df.reindex(product[in_span])
+    if ffill_missing:
+        df = df.groupby(level=group_col, sort=False, observed=True).ffill()
+        df = _restore_int_dtypes(df, dtypes)
+    df = df.reset_index().loc[:, columns]
+    return df.sort_values([date_col, group_col]).reset_index(drop=True)
+
+
+def _fill_missing_date_groups_merge(df, date_col, group_col, ffill_missing):
+    """Fills missing dates one group at a time, allowing repeated dates"""
     def fill_missing_add_group_col(df, group):
         df = fill_missing_date(df, date_col, ffill_missing)
         df[group_col] = group
         return df
-    return group_calc(df, fill_missing_add_group_col, group_col, date_col,
-                      exclude_groups)
+    return group_calc(df, fill_missing_add_group_col, group_col, date_col)
 
 
 def daily_change(df, date_col, dep_var_orig, dep_var_dt, ffill_missing=True):
@@ -95,13 +279,19 @@ def daily_change(df, date_col, dep_var_orig, dep_var_dt, ffill_missing=True):
 
 
 def daily_change_groups(df, date_col, dep_var_orig, dep_var_dt, group_col,
-                        exclude_groups=None, ffill_missing=True):
+                        exclude_groups=None, ffill_missing=True, executor=None,
+                        n_jobs=None):
     """Calculates the daily change for multiple groups"""
-    return group_calc(
-        df,
-        lambda x,y: daily_change(x, date_col, dep_var_orig, dep_var_dt,
-                                 ffill_missing),
-        group_col, date_col, exclude_groups)
+    if executor == 'process':
+        return _run_sharded(daily_change_groups, df, group_col, date_col,
+                            n_jobs, date_col, dep_var_orig, dep_var_dt,
+                            group_col, exclude_groups, ffill_missing)
+    if date_col is not None:
+        df = fill_missing_date_groups(df, date_col, group_col, exclude_groups,
+                                      ffill_missing)
+    df, positions = _sort_groups(df, group_col, date_col, exclude_groups)
+    df[dep_var_dt] = df[dep_var_orig].diff().where(positions != 0)
+    return _restore_group_order(df, date_col, group_col)
 
 
 def rolling_avg(df, date_col, dep_var_orig, dep_var_rolling_avg, window,
@@ -117,34 +307,103 @@ def rolling_avg(df, date_col, dep_var_orig, dep_var_rolling_avg, window,
 
 
 def rolling_avg_groups(df, date_col, dep_var_orig, dep_var_rolling_avg, window,
-                       group_col, exclude_groups=None, ffill_missing=True):
-    return group_calc(
-        df,
-        lambda x,y: rolling_avg(x, date_col, dep_var_orig, dep_var_rolling_avg,
-                                window, ffill_missing),
-        group_col, date_col, exclude_groups)
+                       group_col, exclude_groups=None, ffill_missing=True,
+                       executor=None, n_jobs=None):
+    """Calculates a rolling average for multiple groups"""
+    if executor == 'process':
+        return _run_sharded(rolling_avg_groups, df, group_col, date_col,
+                            n_jobs, date_col, dep_var_orig,
+                            dep_var_rolling_avg, window, group_col,
+                            exclude_groups, ffill_missing)
+    if date_col is not None:
+        df = fill_missing_date_groups(df, date_col, group_col, exclude_groups,
+                                      ffill_missing)
+    df, positions = _sort_groups(df, group_col, date_col, exclude_groups)
+    df[dep_var_rolling_avg] = _rolling_mean_by_group(
+        df[dep_var_orig].astype('float64'), positions, window)
+    return _restore_group_order(df, date_col, group_col)
 
 
 def normalize_population(df, dep_var_orig, dep_var_norm, pop_size,
                          norm_size=1e5):
     """Normalize population metric"""
     df = df.copy()
-    df[dep_var_norm] = df.apply(
-        lambda x: x[dep_var_orig] * norm_size / pop_size,
-        axis='columns'
-    )
+    df[dep_var_norm] = df[dep_var_orig] * norm_size / pop_size
     return df.reset_index(drop=True)
 
 
+def _population_series(population_mapper, groups):
+    """Converts a population mapper to a Series indexed by group"""
+    if isinstance(population_mapper, pd.core.series.Series):
+        return population_mapper
+    if isinstance(population_mapper, dict):
+        return pd.Series(population_mapper, dtype='float64')
+    population_func = mapper_to_func(population_mapper)
+    populations = {}
+    for group in groups:
+        try:
+            populations[group] = population_func(group)
+        except KeyError:
+            pass
+    return pd.Series(populations, dtype='float64')
+
+
+def join_populations(group_values, population_mapper):
+    """Looks up the population of every entry in a group column at once.
+
+    The group column is factorized and joined to the population index a single
+    time, so the cost of the lookup depends on the number of groups rather
+    than the number of rows.
+
+    Args:
+        group_values: A Series or array of group names, such as the State
+            column of a tidy dataframe.
+        population_mapper: A Series indexed by group, such as
+            STATE_POPULATIONS or CA_COUNTY_POPULATIONS. A dict or a function
+            taking a group name are also accepted.
+    Returns:
+        A tuple of a float64 array with the population of each entry, NaN where
+        no population is known, and a list of the groups missing a population.
+    """
+    codes, groups = pd.factorize(group_values)
+    populations = _population_series(population_mapper, groups)
+    indexer = populations.index.get_indexer(groups)
+    group_populations = np.where(
+        indexer >= 0,
+        populations.to_numpy(dtype='float64', na_value=np.nan)[indexer],
+        np.nan)
+    missing = list(groups[np.isnan(group_populations)])
+    group_populations = np.append(group_populations, np.nan)
+    return group_populations[codes], missing
+
+
+def _group_populations(df, group_col, population_mapper):
+    """Broadcasts populations to each row, warning about any missing groups"""
+    populations, missing = join_populations(df[group_col], population_mapper)
+    if missing:
+        warn_caller(f'No population for {group_col} {missing}, normalized '
+                    'values will be missing')
+    return populations
+
+
 def normalize_population_groups(
         df, dep_var_orig, dep_var_norm, group_col, population_mapper,
-        norm_size=1e5, date_col=None, exclude_groups=None):
-    population_func = mapper_to_func(population_mapper)
-    return group_calc(
-        df,
-        lambda x, y: normalize_population(x, dep_var_orig, dep_var_norm,
-                                          population_func(y), norm_size),
-        group_col, date_col, exclude_groups)
+        norm_size=1e5, date_col=None, exclude_groups=None, executor=None,
+        n_jobs=None):
+    """Normalizes a metric by the population of each group in one operation.
+
+    Groups with no known population are reported with a warning and get
+    missing normalized values instead of raising a KeyError.
+    """
+    if executor == 'process':
+        return _run_sharded(normalize_population_groups, df, group_col,
+                            date_col, n_jobs, dep_var_orig, dep_var_norm,
+                            group_col, population_mapper, norm_size, date_col,
+                            exclude_groups)
+    df, _ = _sort_groups(df, group_col, date_col, exclude_groups)
+    df[dep_var_norm] = (df[dep_var_orig] * norm_size
+                        / _group_populations(df, group_col, population_mapper))
+    return _restore_group_order(df, date_col, group_col)
 
 
 def combine_groups(df, date_col, subgroup_col, group_mapper, group_col):
@@ -156,87 +415,759 @@ def combine_groups(df, date_col, subgroup_col, group_mapper, group_col):
     return df.groupby([date_col, group_col]).sum().reset_index()
 
 
+def combine_groups_chunked(chunks, date_col, subgroup_col, group_mapper,
+                           group_col):
+    """Aggregates chunks of entries into larger groups as they arrive.
+
+    Each chunk is reduced with combine_groups and added to a running total,
+    so only one chunk and the aggregate, which has one row per date and
+    group, are held in memory at a time.
+
+    Args:
+        chunks: An iterable of tidy dataframes, such as query.iter_jhu_us().
+    Returns:
+        The sums of combine_groups on the concatenated chunks, sorted by date
+        and group.
+    """
+    total = None
+    for chunk in chunks:
+        value_cols = list(chunk.select_dtypes('number').columns)
+        # Chunks carry their own categories, so map the plain values
+        chunk = chunk.loc[:, [date_col, subgroup_col] + value_cols].astype(
+            {subgroup_col: object})
+        partial = combine_groups(chunk, date_col, subgroup_col, group_mapper,
+                                 group_col).set_index([date_col, group_col])
+        partial = partial.loc[:, value_cols]
+        total = partial if total is None else total.add(partial,
+                                                        fill_value=0)
+    return total.sort_index().reset_index()
+
+
+def compute_all_groups_chunked(chunks, date_col, var_col, group_col,
+                               *args, **kwargs):
+    """Runs compute_all_groups over a stream of chunks.
+
+    Groups must occupy consecutive locations of the source, as states and
+    counties do in the JHU files, though a group may be split between two
+    chunks. The rows of the group reaching the end of each chunk are held
+    back and computed with the next chunk, so each group is computed exactly
+    once from all its rows. Memory stays bounded by a chunk plus one group.
+
+    Args:
+        chunks: An iterable of tidy dataframes, such as query.iter_jhu_us().
+        The remaining arguments are passed to compute_all_groups.
+    Yields:
+        The output of compute_all_groups for the complete groups of each
+        chunk.
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        last_group = chunk[group_col].iloc[-1]
+        is_last = (chunk[group_col] == last_group).to_numpy()
+        carry = chunk[is_last]
+        if not is_last.all():
+            yield compute_all_groups(chunk[~is_last], date_col, var_col,
+                                     group_col, *args, **kwargs)
+    if carry is not None and len(carry):
+        yield compute_all_groups(carry, date_col, var_col, group_col, *args,
+                                 **kwargs)
+
+
 def _check_tuple_param(param):
     return isinstance(param, tuple) and len(param) == 2
 
 
+def _resolve_output_col(col, temp_name, default_round, columns_to_drop,
+                        columns_to_round):
+    """Resolves an optional output column of compute_all to its name.
+
+    Columns which are not requested get a temporary name and are marked to be
+    dropped, and requested columns are marked to be rounded.
+    """
+    if col is None:
+        columns_to_drop.append(temp_name)
+        return temp_name
+    if _check_tuple_param(col):
+        columns_to_round[col[0]] = col[1]
+        return col[0]
+    columns_to_round[col] = default_round
+    return col
+
+
+def _derived_array(values, decimals=None):
+    """Rounds a derived column and casts it to the derived dtype"""
+    if decimals is not None:
+        values = np.round(values, decimals)
+    return values.astype(DTYPES['derived'], copy=False)
+
+
+def _finalize_computed(df, var_col, derived_cols, columns_to_drop,
+                       columns_to_round):
+    """Drops rows missing var_col and the temporary columns, and rounds and
+    casts the derived columns.
+
+    The other columns keep their dtypes, so the compact dtypes of the loaders
+    carry through.
+    """
+    df = df[df[var_col].notna()].drop(columns=columns_to_drop)
+    df = df.reset_index(drop=True)
+    for col in derived_cols:
+        if col in df:
+            df[col] = _derived_array(
+                df[col].to_numpy(dtype='float64', na_value=np.nan),
+                columns_to_round.get(col))
+    return df
+
+
+def _reindex_dates(df, date_col, ffill_missing=True):
+    """Fills missing days of a single group with one reindex"""
+    if not df[date_col].is_unique:
+        return fill_missing_date(df, date_col, ffill_missing)
+    df = df.set_index(date_col)
+    dtypes = df.dtypes
+    df = df.reindex(pd.date_range(df.index.min(), df.index.max(),
+                                  name=date_col))
+    if ffill_missing:
+        df = _restore_int_dtypes(df.ffill(), dtypes)
+    return df.reset_index()
+
+
+def _fused_output_col(col, default_round):
+    """Splits an optional output column into its name and rounding"""
+    if _check_tuple_param(col):
+        return col
+    return col, default_round
+
+
+def _compute_all_fused(df, positions, var_col, var_dt_col, var_dt_avg_col,
+                       var_norm_col, var_dt_norm_avg_col, populations,
+                       avg_window, norm_size, order=None):
+    """Computes every derived column from the underlying arrays in one pass.
+
+    Args:
+        df: A dataframe with no date gaps, sorted so that each group is
+            contiguous and in date order.
+        positions: The position of each row within its group.
+        populations: None, or a scalar or array with the population of each
+            row.
+        order: An optional permutation of the rows giving the output order.
+    Returns:
+        A new dataframe holding the original columns and the requested derived
+        columns, built in a single allocation. Derived columns which were not
+        requested are never materialized.
+    """
+    values = df[var_col].to_numpy(dtype='float64', na_value=np.nan)
+    var_dt = np.empty_like(values)
+    var_dt[:1] = np.nan
+    np.subtract(values[1:], values[:-1], out=var_dt[1:])
+    var_dt[positions == 0] = np.nan
+    var_dt_avg = _rolling_mean_by_group(var_dt, positions, avg_window)
+
+    derived = [(var_dt_col, None, var_dt)]
+    derived.append((*_fused_output_col(var_dt_avg_col, 1), var_dt_avg))
+    if populations is not None:
+        scale = norm_size / np.asarray(populations, dtype='float64')
+        derived.append(
+            (*_fused_output_col(var_norm_col, 1), values * scale))
+        derived.append(
+            (*_fused_output_col(var_dt_norm_avg_col, 2), var_dt_avg * scale))
+
+    keep = ~np.isnan(values)
+    rows = np.flatnonzero(keep) if order is None else order[keep[order]]
+    columns = {col: df[col].array.take(rows) for col in df.columns}
+    for col, decimals, array in derived:
+        if col is None:
+            continue
+        columns[col] = _derived_array(array[rows], decimals)
+    return pd.DataFrame(columns)
+
+
+@traced('compute_all')
 def compute_all(df, date_col, var_col, var_dt_col=None, var_dt_avg_col=None,
                 var_norm_col=None, var_dt_norm_avg_col=None,
                 pop_size=None, avg_window=14, norm_size=1e5,
-                ffill_missing=True):
+                ffill_missing=True, fused=False):
+    """Computes the daily change, its rolling average and, given a population,
+    the normalized values of a single time series.
+
+    Passing fused=True reindexes the dates once and computes every derived
+    column straight from the underlying arrays, skipping the intermediate
+    copies.
+
+    Either way, the original columns keep their dtypes and the derived
+    columns are NumPy floats of DTYPES['derived'], with NaN where missing.
+    """
+    if fused:
+        if date_col is not None:
+            df = _reindex_dates(df, date_col, ffill_missing)
+        return _compute_all_fused(
+            df, np.arange(len(df)), var_col, var_dt_col, var_dt_avg_col,
+            var_norm_col, var_dt_norm_avg_col, pop_size, avg_window,
+            norm_size)
+
     columns_to_drop = []
     columns_to_round = {}
     if var_dt_col is None:
         var_dt_col = 'temp_dt'
         columns_to_drop.append(var_dt_col)
-    if var_dt_avg_col is None:
-        var_dt_avg_col = 'temp_dt_avg'
-        columns_to_drop.append(var_dt_avg_col)
-    elif _check_tuple_param(var_dt_avg_col):
-        columns_to_round[var_dt_avg_col[0]] = var_dt_avg_col[1]
-        var_dt_avg_col = var_dt_avg_col[0]
-    else:
-        columns_to_round[var_dt_avg_col] = 1
+    var_dt_avg_col = _resolve_output_col(var_dt_avg_col, 'temp_dt_avg', 1,
+                                         columns_to_drop, columns_to_round)
 
     df = daily_change(df, date_col, var_col, var_dt_col, ffill_missing)
     df = rolling_avg(df, None, var_dt_col, var_dt_avg_col, avg_window)
 
     if pop_size is not None:
-        if var_norm_col is None:
-            var_norm_col = 'temp_norm'
-            columns_to_drop.append(var_norm_col)
-        elif _check_tuple_param(var_norm_col):
-            columns_to_round[var_norm_col[0]] = var_norm_col[1]
-            var_norm_col = var_norm_col[0]
-        else:
-            columns_to_round[var_norm_col] = 1
-        if var_dt_norm_avg_col is None:
-            var_dt_norm_avg_col = 'temp_dt_norm_avg'
-            columns_to_drop.append(var_dt_norm_avg_col)
-        elif _check_tuple_param(var_dt_norm_avg_col):
-            columns_to_round[var_dt_norm_avg_col[0]] = var_dt_norm_avg_col[1]
-            var_dt_norm_avg_col = var_dt_norm_avg_col[0]
-        else:
-            columns_to_round[var_dt_norm_avg_col] = 2
+        var_norm_col = _resolve_output_col(
+            var_norm_col, 'temp_norm', 1, columns_to_drop, columns_to_round)
+        var_dt_norm_avg_col = _resolve_output_col(
+            var_dt_norm_avg_col, 'temp_dt_norm_avg', 2, columns_to_drop,
+            columns_to_round)
 
         df = normalize_population(df, var_col, var_norm_col,
                                   pop_size, norm_size)
         df = normalize_population(df, var_dt_avg_col, var_dt_norm_avg_col,
                                   pop_size, norm_size)
 
-    df = df[df[var_col].notna()].reset_index(drop=True).copy()
-    df = df.convert_dtypes()
-    for col in columns_to_round:
+    derived_cols = [var_dt_col, var_dt_avg_col, var_norm_col,
+                    var_dt_norm_avg_col]
+    return _finalize_computed(df, var_col, derived_cols, columns_to_drop,
+                              columns_to_round)
+
+
+RESULT_CACHE_SIZE = 8
+RESULT_CACHE_DIR = None
+RESULT_CACHE_DISK_SIZE = 32
+RESULT_CACHE_VERSION = 1
+RESULT_CACHE_STATS = {'hits': 0, 'disk_hits': 0, 'misses': 0,
+                      'invalidations': 0}
+FINGERPRINT_SAMPLE_ROWS = 1024
+_result_cache = collections.OrderedDict()
+_result_lock = threading.RLock()
+_fingerprints = {}
+# Under copy-on-write, always on from pandas 3, a shallow copy of a cached
+# result cannot be used to modify it
+_SHALLOW_COPY_SAFE = int(pd.__version__.split('.')[0]) >= 3
+
+
+def _hash_frame(df, index=False):
+    """A digest of the values and dtypes of a dataframe or series"""
+    hashes = pd.util.hash_pandas_object(df, index=index).to_numpy()
+    digest = hashlib.blake2b(hashes.tobytes(), digest_size=16)
+    digest.update(repr(df.shape).encode())
+    if isinstance(df, pd.DataFrame):
+        digest.update(repr(list(df.columns)).encode())
+        digest.update(repr([str(x) for x in df.dtypes]).encode())
+    else:
+        digest.update(str(df.dtype).encode())
+    return digest.hexdigest()
+
+
+def frame_fingerprint(df, index=False, trust_identity=False):
+    """A digest of the values and dtypes of a dataframe or series.
+
+    Every row is hashed, so an edit in place changes the digest. With
+    trust_identity, the digest of each frame is remembered for as long as the
+    frame is alive and reused when the same frame is passed again with the
+    same shape, dtypes and values at FINGERPRINT_SAMPLE_ROWS evenly spaced
+    rows. That skips hashing every row, but an edit in place to rows outside
+    of that sample goes unnoticed.
+    """
+    if not trust_identity:
+        return _hash_frame(df, index)
+    step = max(1, len(df) // FINGERPRINT_SAMPLE_ROWS)
+    pre_key = (index, _hash_frame(df.iloc[::step], index), len(df))
+    with _result_lock:
+        memo = _fingerprints.get(id(df))
+    if memo is not None and memo[0]() is df and memo[1] == pre_key:
+        return memo[2]
+    fingerprint = _hash_frame(df, index)
+    key = id(df)
+    ref = weakref.ref(df, lambda _: _fingerprints.pop(key, None))
+    with _result_lock:
+        _fingerprints[key] = (ref, pre_key, fingerprint)
+    return fingerprint
+
+
+def _mapper_key(population_mapper):
+    """A cache key for a population mapper.
+
+    Series and dicts are keyed on their contents. Functions are keyed on
+    themselves, so a function must not change what it returns while its
+    results are cached.
+    """
+    if population_mapper is None or callable(population_mapper):
+        return population_mapper
+    if not isinstance(population_mapper, pd.Series):
+        population_mapper = pd.Series(population_mapper)
+    return frame_fingerprint(population_mapper, index=True)
+
+
+def _result_path(key):
+    """The file of a result in the disk cache, or None if not kept on disk"""
+    if RESULT_CACHE_DIR is None or feather is None:
+        return None
+    # Functions are only equal to themselves within a process
+    if any(callable(x) for x in key):
+        return None
+    digest = hashlib.blake2b(repr((RESULT_CACHE_VERSION,) + key).encode(),
+                             digest_size=16)
+    return os.path.join(RESULT_CACHE_DIR, digest.hexdigest() + '.feather')
+
+
+def _remember_result(key, result):
+    _result_cache[key] = result
+    _result_cache.move_to_end(key)
+    while len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+
+
+def _cached_result(key):
+    """Looks a result up in memory and then on disk, counting the outcome"""
+    with _result_lock:
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+            RESULT_CACHE_STATS['hits'] += 1
+            return _result_cache[key]
+        path = _result_path(key)
+        result = None
+        if path is not None:
+            try:
+                result = feather.read_feather(path)
+                # Mark the file as recently used for pruning
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        if result is None:
+            RESULT_CACHE_STATS['misses'] += 1
+            return None
+        RESULT_CACHE_STATS['disk_hits'] += 1
+        _remember_result(key, result)
+        return result
+
+
+def _store_result(key, result):
+    with _result_lock:
+        _remember_result(key, result)
+        path = _result_path(key)
+        if path is None:
+            return
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        write_feather_atomic(path, result)
+        _prune_result_dir()
+
+
+def _result_files():
+    if RESULT_CACHE_DIR is None or not os.path.isdir(RESULT_CACHE_DIR):
+        return []
+    return [os.path.join(RESULT_CACHE_DIR, x)
+            for x in os.listdir(RESULT_CACHE_DIR) if x.endswith('.feather')]
+
+
+def _remove_files(paths):
+    # Another process sharing the directory may have removed them already
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _prune_result_dir():
+    """Removes the least recently used results beyond RESULT_CACHE_DISK_SIZE"""
+    mtimes = {}
+    for path in _result_files():
         try:
-            df[col] = df[col].copy().fillna(np.nan).round(columns_to_round[col])
-        except AttributeError:
+            mtimes[path] = os.path.getmtime(path)
+        except FileNotFoundError:
             pass
-    return df.drop(columns=columns_to_drop)
+    paths = sorted(mtimes, key=mtimes.get, reverse=True)
+    _remove_files(paths[RESULT_CACHE_DISK_SIZE:])
+
+
+def clear_result_cache(disk=True):
+    """Drops the cached results of compute_all_groups.
+
+    Results are keyed on the contents of their input, so a stale result is
+    never returned unless cache='trust_identity' was used. Results of data
+    which has since been refreshed would otherwise hold memory and disk space
+    until evicted. query.fetch_sources and loads with fetch=True call this
+    once their sources have changed.
+
+    Args:
+        disk: Whether to remove the results in RESULT_CACHE_DIR as well.
+    """
+    with _result_lock:
+        _result_cache.clear()
+        _fingerprints.clear()
+        if disk:
+            _remove_files(_result_files())
+        RESULT_CACHE_STATS['invalidations'] += 1
 
 
+@traced('compute_all_groups')
 def compute_all_groups(
     df, date_col, var_col, group_col, var_dt_col=None, var_dt_avg_col=None,
     var_norm_col=None, var_dt_norm_avg_col=None, population_mapper=None,
-    avg_window=14, norm_size=1e5, exclude_groups=None, ffill_missing=True):
-    population_func = mapper_to_func(population_mapper)
-    if any((var_norm_col, var_dt_norm_avg_col)):
-        if population_func is None:
-            raise ValueError('Population mapper not specified')
-        return group_calc(
-            df,
-            lambda x, y: compute_all(
-                x, date_col, var_col, var_dt_col, var_dt_avg_col,
-                var_norm_col, var_dt_norm_avg_col, population_func(y),
-                avg_window, norm_size, ffill_missing
-            ), group_col, date_col, exclude_groups
-        )
-    return group_calc(
-        df,
-        lambda x, y: compute_all(
-            x, date_col, var_col, var_dt_col, var_dt_avg_col, avg_window,
-            ffill_missing=ffill_missing
-        ), group_col, date_col, exclude_groups
-    )
+    avg_window=14, norm_size=1e5, exclude_groups=None, ffill_missing=True,
+    fused=False, executor=None, n_jobs=None, cache=False):
+    """Performs compute_all on every group in a single vectorized pass.
+
+    Rather than running compute_all once per group, the dataframe is
+    partitioned once and each derived column is calculated for all groups at
+    the same time. The result matches calling compute_all on each group and
+    combining them with group_calc. fused has the same meaning as in
+    compute_all.
+
+    With cache, the last RESULT_CACHE_SIZE results are kept in memory, keyed
+    on a hash of the contents of df and on the arguments, so repeating a call
+    on the same data only costs the hash and a copy. If RESULT_CACHE_DIR is
+    set, results are also written there as Feather files, up to
+    RESULT_CACHE_DISK_SIZE of them, so that they outlive the process. Hits
+    and misses are counted in RESULT_CACHE_STATS.
+
+    With cache='trust_identity', the hash of a frame passed again is reused
+    after checking only a sample of its rows. That makes hits cheaper but
+    misses edits in place to the other rows, so only use it for frames which
+    are not modified.
+    """
+    normalize = any((var_norm_col, var_dt_norm_avg_col))
+    if normalize and population_mapper is None:
+        raise ValueError('Population mapper not specified')
+    if cache:
+        fingerprint = frame_fingerprint(
+            df, trust_identity=cache == 'trust_identity')
+        key = (fingerprint, date_col, var_col, group_col,
+               var_dt_col, var_dt_avg_col, var_norm_col, var_dt_norm_avg_col,
+               _mapper_key(population_mapper), avg_window, norm_size,
+               None if exclude_groups is None else tuple(exclude_groups),
+               ffill_missing, fused, DTYPES['derived'])
+        result = _cached_result(key)
+        if result is None:
+            result = compute_all_groups(
+                df, date_col, var_col, group_col, var_dt_col, var_dt_avg_col,
+                var_norm_col, var_dt_norm_avg_col, population_mapper,
+                avg_window, norm_size, exclude_groups, ffill_missing, fused,
+                executor, n_jobs)
+            _store_result(key, result)
+        # The cached frame is shared, so callers get their own copy
+        return result.copy(deep=not _SHALLOW_COPY_SAFE)
+    if executor == 'process':
+        return _run_sharded(
+            compute_all_groups, df, group_col, date_col, n_jobs, date_col,
+            var_col, group_col, var_dt_col, var_dt_avg_col, var_norm_col,
+            var_dt_norm_avg_col, population_mapper, avg_window, norm_size,
+            exclude_groups, ffill_missing, fused)
+
+    if fused:
+        if date_col is not None:
+            df = fill_missing_date_groups(df, date_col, group_col,
+                                          exclude_groups, ffill_missing)
+        df, positions = _sort_groups(df, group_col, date_col, exclude_groups)
+        populations = (_group_populations(df, group_col, population_mapper)
+                       if normalize else None)
+        sort_list = group_col if date_col is None else [date_col, group_col]
+        order = df[sort_list].sort_values(sort_list).index.to_numpy()
+        return _compute_all_fused(
+            df, positions, var_col, var_dt_col, var_dt_avg_col, var_norm_col,
+            var_dt_norm_avg_col, populations, avg_window, norm_size, order)
+
+    columns_to_drop = []
+    columns_to_round = {}
+    if var_dt_col is None:
+        var_dt_col = 'temp_dt'
+        columns_to_drop.append(var_dt_col)
+    var_dt_avg_col = _resolve_output_col(var_dt_avg_col, 'temp_dt_avg', 1,
+                                         columns_to_drop, columns_to_round)
+
+    if date_col is not None:
+        df = fill_missing_date_groups(df, date_col, group_col, exclude_groups,
+                                      ffill_missing)
+    df, positions = _sort_groups(df, group_col, date_col, exclude_groups)
+    df[var_dt_col] = df[var_col].diff().where(positions != 0)
+    df[var_dt_avg_col] = _rolling_mean_by_group(
+        df[var_dt_col].astype('float64'), positions, avg_window)
+
+    if normalize:
+        var_norm_col = _resolve_output_col(
+            var_norm_col, 'temp_norm', 1, columns_to_drop, columns_to_round)
+        var_dt_norm_avg_col = _resolve_output_col(
+            var_dt_norm_avg_col, 'temp_dt_norm_avg', 2, columns_to_drop,
+            columns_to_round)
+        populations = _group_populations(df, group_col, population_mapper)
+        df[var_norm_col] = df[var_col] * norm_size / populations
+        df[var_dt_norm_avg_col] = df[var_dt_avg_col] * norm_size / populations
+
+    df = _restore_group_order(df, date_col, group_col)
+    derived_cols = [var_dt_col, var_dt_avg_col, var_norm_col,
+                    var_dt_norm_avg_col]
+    return _finalize_computed(df, var_col, derived_cols, columns_to_drop,
+                              columns_to_round)
+
+
+def compute_all_groups_update(
+    df_computed, df_new, date_col, var_col, group_col, var_dt_col=None,
+    var_dt_avg_col=None, var_norm_col=None, var_dt_norm_avg_col=None,
+    population_mapper=None, avg_window=14, norm_size=1e5, exclude_groups=None,
+    ffill_missing=True, fused=False):
+    """Extends the output of compute_all_groups with newly arrived rows.
+
+    Only the last avg_window days of each group are taken from df_computed to
+    seed the new rows, so adding a day does not recompute the whole history.
+    The arguments must match those used to produce df_computed, which must
+    still hold the var_col column. If older rows were revised upstream, call
+    compute_all_groups on the full data instead.
+
+    Args:
+        df_computed: The output of a previous call to compute_all_groups.
+        df_new: Tidy rows dated after the last date of their group in
+            df_computed, with the same columns as the original input.
+    Returns:
+        df_computed with the computed new rows added, in the order of
+        compute_all_groups.
+    """
+    columns = list(df_new.columns)
+    group_last = df_computed.groupby(
+        group_col, sort=False, observed=True)[date_col].transform('max')
+    df_history = df_computed.loc[
+        df_computed[date_col] > group_last - pd.Timedelta(avg_window, 'days'),
+        columns]
+    df_updated = compute_all_groups(
+        pd.concat([df_history, df_new], ignore_index=True), date_col, var_col,
+        group_col, var_dt_col, var_dt_avg_col, var_norm_col,
+        var_dt_norm_avg_col, population_mapper, avg_window, norm_size,
+        exclude_groups, ffill_missing, fused)
+    last_date = df_updated[group_col].astype(object).map(
+        df_computed.groupby(group_col, observed=True)[date_col].max())
+    df_updated = df_updated[~(df_updated[date_col] <= last_date)]
+    return pd.concat([df_computed, df_updated]).sort_values(
+        [date_col, group_col]).reset_index(drop=True)
+
+
+class RollingState:
+    """Running daily change and rolling average of one cumulative series.
+
+    update takes the value of the next day and returns the derived values of
+    that day in constant time. They match what compute_all gives for the same
+    day of the full series. Days skipped between updates are filled forward,
+    or left missing if ffill_missing is False, as in fill_missing_date.
+
+    Attributes:
+        window: The number of days in the rolling average.
+        ffill_missing: Whether missing days and values are filled forward.
+        last_date: The date of the last update, or None before the first.
+        last_value: The value of the last update, NaN if missing.
+        changes: The daily changes of the last window days, NaN if missing.
+    """
+
+    def __init__(self, window=14, ffill_missing=True):
+        self.window = window
+        self.ffill_missing = ffill_missing
+        self.last_date = None
+        self.last_value = np.nan
+        self.changes = collections.deque(maxlen=window)
+        self._window_sum = 0.0
+        self._window_missing = 0
+
+    def _push(self, value):
+        change = value - self.last_value
+        if len(self.changes) == self.window:
+            oldest = self.changes[0]
+            if math.isnan(oldest):
+                self._window_missing -= 1
+            else:
+                self._window_sum -= oldest
+        self.changes.append(change)
+        if math.isnan(change):
+            self._window_missing += 1
+        else:
+            self._window_sum += change
+        self.last_value = value
+        return change
+
+    def rolling_avg(self):
+        """The rolling average of the daily change as of the last update"""
+        if len(self.changes) < self.window or self._window_missing:
+            return np.nan
+        return self._window_sum / self.window
+
+    def update(self, date, value):
+        """Adds the value of a day after the last update.
+
+        Returns:
+            A tuple of the daily change and its rolling average on that day.
+        """
+        date = pd.Timestamp(date)
+        value = np.nan if value is None or pd.isna(value) else float(value)
+        if self.last_date is not None:
+            gap = (date - self.last_date).days
+            if gap <= 0:
+                raise ValueError(f'{date} is not after the last update '
+                                 f'{self.last_date}')
+            # Only the last window skipped days can still affect the average
+            for _ in range(min(gap - 1, self.window)):
+                self._push(self.last_value if self.ffill_missing else np.nan)
+        if math.isnan(value) and self.ffill_missing:
+            value = self.last_value
+        self.last_date = date
+        return self._push(value), self.rolling_avg()
+
+    def to_dict(self):
+        """The state as a dict which can be saved as JSON"""
+        return {
+            'window': self.window,
+            'ffill_missing': self.ffill_missing,
+            'last_date': (None if self.last_date is None
+                          else self.last_date.isoformat()),
+            'last_value': _nan_to_none(self.last_value),
+            'changes': [_nan_to_none(x) for x in self.changes],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Restores a state saved with to_dict"""
+        rolling = cls(state['window'], state['ffill_missing'])
+        if state['last_date'] is not None:
+            rolling.last_date = pd.Timestamp(state['last_date'])
+        changes = [np.nan if x is None else x for x in state['changes']]
+        rolling.changes.extend(changes)
+        rolling._window_missing = sum(math.isnan(x) for x in changes)
+        rolling._window_sum = math.fsum(x for x in changes
+                                        if not math.isnan(x))
+        rolling.last_value = (np.nan if state['last_value'] is None
+                              else state['last_value'])
+        return rolling
+
+
+def _nan_to_none(value):
+    return None if math.isnan(value) else value
+
+
+class GroupRollingState:
+    """A RollingState for every group, updated with new tidy rows.
+
+    The column arguments have the same meaning and defaults as in
+    compute_all_groups, and update returns the same columns for the new
+    rows. Only the last avg_window days of each group are needed to start,
+    and each new row then costs constant time, however long the history.
+    """
+
+    def __init__(self, date_col, var_col, group_col, var_dt_col=None,
+                 var_dt_avg_col=None, var_norm_col=None,
+                 var_dt_norm_avg_col=None, population_mapper=None,
+                 avg_window=14, norm_size=1e5, ffill_missing=True):
+        self.date_col = date_col
+        self.var_col = var_col
+        self.group_col = group_col
+        self.derived_cols = [var_dt_col, var_dt_avg_col, var_norm_col,
+                             var_dt_norm_avg_col]
+        self.population_mapper = population_mapper
+        self.avg_window = avg_window
+        self.norm_size = norm_size
+        self.ffill_missing = ffill_missing
+        self.states = {}
+        self.populations = {}
+
+    @classmethod
+    def from_history(cls, df, date_col, var_col, group_col, *args, **kwargs):
+        """Starts the states from the history of each group in df.
+
+        Only the last avg_window days of each group, and the row before them,
+        are replayed. Takes the same arguments as the constructor after df.
+        """
+        rolling = cls(date_col, var_col, group_col, *args, **kwargs)
+        df = df[df[group_col].notna()].sort_values(date_col, kind='mergesort')
+        group_last = df.groupby(
+            group_col, sort=False, observed=True)[date_col].transform('max')
+        recent = df[date_col] > group_last - pd.Timedelta(
+            rolling.avg_window + 1, 'days')
+        # The last older row of each group seeds the filling of any gap
+        seed = df[~recent].groupby(group_col, sort=False,
+                                   observed=True).tail(1)
+        rolling.update(pd.concat([seed, df[recent]]))
+        return rolling
+
+    def _populations(self, groups):
+        """Looks up the populations of groups which have not been seen"""
+        new_groups = [x for x in groups if x not in self.populations]
+        if new_groups and self.population_mapper is not None:
+            populations, missing = join_populations(
+                pd.Series(new_groups, dtype=object), self.population_mapper)
+            if missing:
+                warn_caller(f'No population for {self.group_col} {missing}, '
+                            'normalized values will be missing')
+            self.populations.update(zip(new_groups, populations))
+        return np.array([self.populations.get(x, np.nan) for x in groups])
+
+    def update(self, df_new):
+        """Adds new rows, dated after the last update of their group.
+
+        Returns:
+            The new rows with the requested derived columns, rounded as in
+            compute_all, and with rows missing var_col dropped.
+        """
+        df_new = df_new[df_new[self.group_col].notna()].copy()
+        groups = df_new[self.group_col].to_numpy(dtype=object)
+        # Filled in place below, so it must not be a view of df_new
+        values = df_new[self.var_col].to_numpy(dtype='float64',
+                                               na_value=np.nan, copy=True)
+        dt = np.empty(len(df_new))
+        dt_avg = np.empty(len(df_new))
+        for i, (group, date) in enumerate(zip(groups, df_new[self.date_col])):
+            state = self.states.get(group)
+            if state is None:
+                state = self.states[group] = RollingState(
+                    self.avg_window, self.ffill_missing)
+            dt[i], dt_avg[i] = state.update(date, values[i])
+            values[i] = state.last_value
+        if self.ffill_missing and df_new[self.var_col].isna().any():
+            df_new[self.var_col] = values
+
+        derived = [(None, dt), (1, dt_avg)]
+        if any(self.derived_cols[2:]):
+            scale = self.norm_size / self._populations(groups)
+            derived.append((1, values * scale))
+            derived.append((2, dt_avg * scale))
+        for col, (decimals, column) in zip(self.derived_cols, derived):
+            if col is None:
+                continue
+            if _check_tuple_param(col):
+                col, decimals = col
+            df_new[col] = _derived_array(column, decimals)
+        return df_new[df_new[self.var_col].notna()].reset_index(drop=True)
+
+    def to_dict(self):
+        """The states and settings as a dict which can be saved as JSON.
+
+        The population_mapper is not saved, only the populations looked up so
+        far, and groups are saved as strings.
+        """
+        return {
+            'columns': [self.date_col, self.var_col, self.group_col,
+                        *self.derived_cols],
+            'avg_window': self.avg_window,
+            'norm_size': self.norm_size,
+            'ffill_missing': self.ffill_missing,
+            'populations': {str(x): _nan_to_none(y)
+                            for x, y in self.populations.items()},
+            'states': {str(x): y.to_dict() for x, y in self.states.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, state, population_mapper=None):
+        """Restores states saved with to_dict"""
+        columns = [tuple(x) if isinstance(x, list) else x
+                   for x in state['columns']]
+        rolling = cls(*columns, population_mapper=population_mapper,
+                      avg_window=state['avg_window'],
+                      norm_size=state['norm_size'],
+                      ffill_missing=state['ffill_missing'])
+        rolling.populations = {x: np.nan if y is None else y
+                               for x, y in state['populations'].items()}
+        rolling.states = {x: RollingState.from_dict(y)
+                          for x, y in state['states'].items()}
+        return rolling
 
 
 if __name__ == "__main__":
@@ -1,7 +1,6 @@
-import pandas as pd
+import functools
 
 from covid_tools.const import *
-import covid_tools.calc
 
 POPULATION_CSV = os.path.join(DATA_DIR, 'ca_county_p1a.csv')
 
@@ -72,13 +71,30 @@ CA_REGIONS = {
     'Yuba': GS,
 }
 
-CA_COUNTIES = pd.read_csv(POPULATION_CSV)
-CA_COUNTIES[REGION] = CA_COUNTIES[COUNTY].apply(
-    CA_REGIONS.get).astype('category')
-CA_COUNTIES.set_index(COUNTY, inplace=True)
-CA_COUNTY_POPULATIONS = CA_COUNTIES.loc[:, POPULATION]
 
-CA_REGION_POPULATIONS = CA_COUNTIES.groupby(REGION).sum().loc[:, POPULATION]
+@functools.lru_cache(maxsize=None)
+def ca_counties():
+    """Population and region of each California county"""
+    import pandas as pd
+    df = pd.read_csv(POPULATION_CSV, dtype={POPULATION: DTYPES['count']})
+    df[REGION] = df[COUNTY].map(CA_REGIONS).astype(DTYPES['label'])
+    return df.set_index(COUNTY)
+
+
+@functools.lru_cache(maxsize=None)
+def ca_region_populations():
+    return ca_counties().groupby(REGION).sum().loc[:, POPULATION]
+
+
+def __getattr__(name):
+    # The county table is read on first access rather than at import.
+    if name == 'CA_COUNTIES':
+        return ca_counties()
+    if name == 'CA_COUNTY_POPULATIONS':
+        return ca_counties().loc[:, POPULATION]
+    if name == 'CA_REGION_POPULATIONS':
+        return ca_region_populations()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 if __name__ == "__main__":
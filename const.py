@@ -6,6 +6,7 @@ CTP = 'ctp'
 JHU = 'jhu'
 ALL = 'all'
 
+NATION = 'Nation'
 STATE = 'State'
 REGION = 'Region'
 COUNTY = 'County'
@@ -14,6 +15,12 @@ JHU_STATE_DROP = ['Diamond Princess', 'Grand Princess']
 
 POPULATION = 'Population'
 
+# The dtypes of loaded and computed data. Labels such as State, County and
+# Region are categorical and counts are int32. Derived metrics, such as daily
+# changes, averages and per-100k values, are float64 by default and may be set
+# to float32 to halve their footprint, at about seven significant digits.
+DTYPES = {'label': 'category', 'count': 'int32', 'derived': 'float64'}
+
 DATE = 'Date'
 CASES = 'Cases'
 DEATHS = 'Deaths'
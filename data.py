@@ -1,5 +1,13 @@
+import functools
+import warnings
+from collections.abc import Mapping
+
+import numpy as np
 import pandas as pd
 
+from covid_tools.const import *
+from covid_tools.calc import join_populations
+
 WEEKDAY_MAP = {
     0: 'Monday',
     1: 'Tuesday',
@@ -12,35 +20,177 @@ WEEKDAY_MAP = {
 
 def make_region(df, names, populations, date_col, name_col,
                 case_col, rate_multiplier=1e5):
-    """ Groups areas together to make custom region """
-    pass
+    """ Groups areas together to make custom regions
+
+    Which region each area belongs to is worked out once per definition and
+    set of areas and memoized, so repeated queries for the same regions only
+    do the grouped sum.
+
+    Args:
+        df: A tidy dataframe with at most one row per area and date.
+        names: A dict mapping area names to region names, such as CA_REGIONS,
+            or a collection of area names making up a single region, which
+            is named after its areas.
+        populations: A Series, dict or function giving the population of
+            each area, as accepted by calc.join_populations.
+        date_col: The column holding the date.
+        name_col: The column holding the area names.
+        case_col: The column to sum over the areas of each region.
+        rate_multiplier: The population size of the rate.
+    Returns:
+        A tidy dataframe with the Region, the date, the summed cases, the
+        Population and the cases per rate_multiplier people of each region,
+        ordered by region and date.
+    """
+    if not isinstance(names, Mapping):
+        names = list(names)
+        names = dict.fromkeys(names, ', '.join(map(str, names)))
+    definition = tuple(names.items())
+    area_codes, areas = _area_codes(df[name_col])
+    area_regions, regions = _region_membership(definition, tuple(areas))
+    row_regions = np.append(area_regions, -1)[area_codes]
+    in_region = row_regions >= 0
+    row_regions = row_regions[in_region]
+    date_codes, dates = pd.factorize(df[date_col][in_region], sort=True)
+    cells = row_regions * len(dates) + date_codes
+    n_cells = len(regions) * len(dates)
+
+    cases = df[case_col][in_region].to_numpy(dtype='float64', na_value=np.nan)
+    counts = np.bincount(cells, minlength=n_cells)
+    sums = np.bincount(cells, weights=np.nan_to_num(cases), minlength=n_cells)
+    observed = np.flatnonzero(counts)
+    region_populations = _region_populations(names, regions, populations)
+    rate_label = ('100k' if rate_multiplier == 1e5
+                  else f'{rate_multiplier:,.0f}')
+    df_region = pd.DataFrame({
+        REGION: pd.Categorical.from_codes(observed // len(dates), regions),
+        date_col: dates[observed % len(dates)],
+        case_col: sums[observed],
+        POPULATION: region_populations[observed // len(dates)],
+    })
+    if pd.api.types.is_integer_dtype(df[case_col].dtype):
+        df_region[case_col] = df_region[case_col].astype(DTYPES['count'])
+    df_region[f'{case_col} per {rate_label}'] = (
+        df_region[case_col] * rate_multiplier / df_region[POPULATION]
+    ).astype(DTYPES['derived'])
+    return df_region
+
+def _area_codes(names):
+    """ Integer codes of the areas of a column, and the areas they index """
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        return names.cat.codes.to_numpy(), names.cat.categories
+    return pd.factorize(names)
+
+@functools.lru_cache(maxsize=32)
+def _region_membership(definition, areas):
+    """ Maps the index of each area to the index of its region, or -1 """
+    area_region = dict(definition)
+    regions = pd.Index(pd.unique(pd.Series(list(area_region.values()),
+                                           dtype=object))).sort_values()
+    region_codes = regions.get_indexer([area_region.get(x) for x in areas])
+    return region_codes, regions
+
+def _region_populations(names, regions, populations):
+    """ Sums the populations of the member areas of each region """
+    area_populations, missing = join_populations(
+        pd.Series(list(names), dtype=object), populations)
+    if missing:
+        warnings.warn(f'No population for {missing}, region rates will be '
+                      'too high', stacklevel=3)
+    return np.bincount(
+        regions.get_indexer(list(names.values())),
+        weights=np.nan_to_num(area_populations), minlength=len(regions))
 
 def new_cases_weekday_breakdown(
         df, new_cases_col, weeks_back=4, date_col='date'):
     df = df[df[date_col]>(df[date_col].max()-pd.Timedelta(7*weeks_back, 'days'))].copy()
-    df['dayOfWeek'] = df[date_col].apply(lambda x: x.weekday())
+    df['dayOfWeek'] = df[date_col].dt.dayofweek
     monthly_cases = df[new_cases_col].sum()
-    df_dist = df.groupby('dayOfWeek').sum()
+    df_dist = df.groupby('dayOfWeek')[[new_cases_col]].sum()
     df_dist.rename(index=WEEKDAY_MAP, inplace=True)
-    df_dist['propCases'] = df_dist[
-        new_cases_col].apply(lambda x: round(x/monthly_cases*100,2))
+    df_dist['propCases'] = (df_dist[new_cases_col]/monthly_cases*100).round(2)
     return df_dist.loc[:, ['propCases']]
 
 def weekday_ratio_over_average(
     df, numerator_col, denominator_col, date_col='date', weights=(25, 25, 25, 25)):
-    df = df.loc[:, [date_col, numerator_col, denominator_col]].copy()
-    df.sort_values(date_col, inplace=True)
-    df['dayOfWeek'] = df[date_col].apply(lambda x: x.weekday())
-    df['dailyRatio'] = df[numerator_col] / df[denominator_col]
-    
-    weekday_ratio = {}
-    weights_sum = sum(weights)
-    weights_normalized = [x/weights_sum for x in weights]
-    for i in WEEKDAY_MAP:
-        weekday_series = df.loc[df['dayOfWeek']==i, 'dailyRatio']
-        weekday_series = weekday_series.iloc[::-1]
-        ratio_dot_product = [
-            weekday_series.iloc[x]*weights_normalized[x]
-            for x in range(len(weights_normalized))]
-        weekday_ratio[WEEKDAY_MAP[i]] = round(sum(ratio_dot_product), 4)
-    return weekday_ratio
+    """ Weighted ratio of numerator to denominator on each day of the week
+
+    The most recent occurrence of each weekday gets the first weight, the one
+    before it the second weight and so on. A weekday with fewer occurrences
+    than weights uses the weights of the occurrences it has, rescaled to sum
+    to one.
+
+    Returns:
+        A dict of weekday names to ratios rounded to 4 decimals, or NaN for
+        weekdays not in df.
+    """
+    ratios = weekday_ratio_over_average_groups(
+        df.assign(_group=0), numerator_col, denominator_col, '_group',
+        date_col, weights)
+    return ratios.iloc[0].to_dict()
+
+def _weekday_codes(df, group_col, date_col):
+    """ Integer codes of the (group, weekday) cells of the rows """
+    codes, groups = pd.factorize(df[group_col], sort=True)
+    return codes * 7 + df[date_col].dt.dayofweek.to_numpy(), groups
+
+def _weekday_frame(values, groups, group_col):
+    return pd.DataFrame(
+        values.reshape(len(groups), 7),
+        index=pd.Index(groups, name=group_col),
+        columns=list(WEEKDAY_MAP.values()))
+
+def new_cases_weekday_breakdown_groups(
+        df, new_cases_col, group_col, weeks_back=4, date_col='date'):
+    """ new_cases_weekday_breakdown for every group at once
+
+    Each group is restricted to the weeks_back weeks up to its own last date.
+
+    Returns:
+        A dataframe indexed by group with one column per weekday, holding
+        the percentage of the group's new cases reported on that weekday.
+    """
+    df = df[df[group_col].notna()]
+    last_date = df.groupby(
+        group_col, observed=True, sort=False)[date_col].transform('max')
+    df = df[df[date_col] > last_date - pd.Timedelta(7*weeks_back, 'days')]
+    cells, groups = _weekday_codes(df, group_col, date_col)
+    new_cases = np.nan_to_num(df[new_cases_col].to_numpy(dtype='float64'))
+    sums = np.bincount(cells, weights=new_cases, minlength=len(groups)*7)
+    sums = sums.reshape(len(groups), 7)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prop = sums / sums.sum(axis=1, keepdims=True) * 100
+    return _weekday_frame(np.round(prop, 2), groups, group_col)
+
+def weekday_ratio_over_average_groups(
+        df, numerator_col, denominator_col, group_col, date_col='date',
+        weights=(25, 25, 25, 25)):
+    """ weekday_ratio_over_average for every group at once
+
+    Returns:
+        A dataframe indexed by group with one column per weekday, holding
+        the weighted ratios rounded to 4 decimals.
+    """
+    df = df[df[group_col].notna()]
+    cells, groups = _weekday_codes(df, group_col, date_col)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = (df[numerator_col].to_numpy(dtype='float64')
+                 / df[denominator_col].to_numpy(dtype='float64'))
+    # Order rows by cell and then from the most recent date, so the position
+    # of a row within its cell is the index of its weight
+    order = np.lexsort((-df[date_col].to_numpy().astype('int64'), cells))
+    cells, ratio = cells[order], ratio[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    run_lengths = np.diff(np.r_[starts, len(cells)])
+    positions = np.arange(len(cells)) - np.repeat(starts, run_lengths)
+    used = positions < len(weights)
+    cells, ratio = cells[used], ratio[used]
+    cell_weights = np.asarray(weights, dtype='float64')[positions[used]]
+    n_cells = len(groups) * 7
+    total_weight = np.bincount(cells, weights=cell_weights,
+                               minlength=n_cells)
+    ratios = np.bincount(
+        cells, weights=ratio * (cell_weights / total_weight[cells]),
+        minlength=n_cells)
+    ratios[total_weight == 0] = np.nan
+    return _weekday_frame(np.round(ratios, 4), groups, group_col)
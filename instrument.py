@@ -0,0 +1,251 @@
+"""Opt-in tracing of the stages of a data refresh.
+
+Tracing is off until a block is run under tracing(). Instrumented functions
+then record a stage with its wall time, the rows going in and out, any other
+counts they report, such as bytes read, and optionally the peak memory
+traced by tracemalloc. Stages may nest and may run on several threads. When
+tracing is off, a stage is a shared no-op, so the instrumented functions
+only pay for a global lookup.
+
+    with tracing(memory=True) as tracer:
+        compute_all_groups(load_jhu_us(), ...)
+    tracer.save('refresh.json')
+
+The saved file is in the Chrome trace event format, and can be opened in
+chrome://tracing or https://ui.perfetto.dev. Stages run in worker processes
+by executor='process' are not recorded.
+"""
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+
+_tracer = None
+# Added in Python 3.9. Without it, the peak of a stage is the highest traced
+# memory since tracing began, an upper bound on the stage's own peak.
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)
+
+
+class Tracer:
+    """Collects the stages recorded while tracing is on.
+
+    Attributes:
+        events: A list of dicts, one per finished stage, with its name,
+            thread, start and duration in microseconds since tracing began,
+            and its recorded args.
+        memory: Whether peak memory is traced.
+    """
+
+    def __init__(self, memory=False):
+        self.events = []
+        self.memory = memory
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self):
+        """Totals the duration and count of each stage name.
+
+        Returns:
+            A dict of stage names to their count and total seconds, in order
+            of decreasing total.
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['name'],
+                                      {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += event['dur'] / 1e6
+        return dict(sorted(totals.items(),
+                           key=lambda x: x[1]['seconds'], reverse=True))
+
+    def to_chrome_trace(self):
+        """The stages as a Chrome trace, a dict with a traceEvents list"""
+        pid = os.getpid()
+        return {'traceEvents': [
+            {'name': x['name'], 'ph': 'X', 'ts': x['ts'], 'dur': x['dur'],
+             'pid': pid, 'tid': x['tid'], 'args': x['args']}
+            for x in self.events]}
+
+    def save(self, path, chrome=True):
+        """Writes the stages as a Chrome trace, or as the plain event list"""
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace() if chrome else self.events, f,
+                      default=str)
+
+
+class _Stage:
+    """A stage being recorded, used as a context manager"""
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def record(self, **args):
+        """Adds counts or other details to the stage"""
+        self.args.update(args)
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if self.tracer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if _reset_peak is not None:
+                # The peak is reset for this stage, so fold the peak so far
+                # into the enclosing stage first
+                if stack:
+                    stack[-1]._peak = max(stack[-1]._peak, peak)
+                _reset_peak()
+            self._start_memory = self._peak = current
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        stack = self.tracer._stack()
+        stack.pop()
+        if self.tracer.memory:
+            self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self.args['peak_mb'] = (self._peak - self._start_memory) / 2**20
+            if stack:
+                stack[-1]._peak = max(stack[-1]._peak, self._peak)
+            if _reset_peak is not None:
+                _reset_peak()
+        if exc_type is not None:
+            self.args['error'] = repr(exc)
+        origin = self.tracer._origin
+        self.tracer._add({
+            'name': self.name,
+            'tid': threading.get_ident(),
+            'ts': (self._start - origin) * 1e6,
+            'dur': (end - self._start) * 1e6,
+            'args': self.args,
+        })
+        return False
+
+
+class _NullStage:
+    """The stage handed out while tracing is off"""
+
+    def record(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def enabled():
+    return _tracer is not None
+
+
+def stage(name, **args):
+    """A context manager recording a stage, with args as its details.
+
+    The stage's record method adds details known only once it has run, such
+    as rows_out or bytes_read.
+    """
+    if _tracer is None:
+        return _NULL_STAGE
+    return _Stage(_tracer, name, args)
+
+
+def current_stage():
+    """The innermost stage being recorded on this thread, or a no-op"""
+    if _tracer is None:
+        return _NULL_STAGE
+    stack = _tracer._stack()
+    return stack[-1] if stack else _NULL_STAGE
+
+
+def _rows(value):
+    shape = getattr(value, 'shape', None)
+    return shape[0] if shape else None
+
+
+def traced(name=None):
+    """Decorates a function to record each call as a stage.
+
+    The rows of the first argument and of the result are recorded as rows_in
+    and rows_out when they are dataframes or arrays.
+    """
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _Stage(_tracer, stage_name, {}) as current:
+                if args and _rows(args[0]) is not None:
+                    current.args['rows_in'] = _rows(args[0])
+                result = func(*args, **kwargs)
+                if _rows(result) is not None:
+                    current.args['rows_out'] = _rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def warn_caller(message, category=UserWarning):
+    """Warns at the first caller outside of the module issuing the warning.
+
+    A fixed stacklevel is thrown off by the wrapper frames of traced and by
+    calls nested within the module, so frames of both are skipped instead.
+    """
+    frame = sys._getframe(1)
+    skipped = (frame.f_globals.get('__name__'), __name__)
+    # stacklevel=2 is the frame calling this function
+    level = 2
+    while frame is not None and frame.f_globals.get('__name__') in skipped:
+        frame = frame.f_back
+        level += 1
+    warnings.warn(message, category, stacklevel=level)
+
+
+@contextlib.contextmanager
+def tracing(memory=False):
+    """Turns tracing on for the duration of the block.
+
+    Args:
+        memory: Whether to trace the peak memory of each stage, which slows
+            down allocations while tracing. Before Python 3.9 this is only
+            an upper bound, see _reset_peak.
+    Yields:
+        The Tracer collecting the stages.
+    """
+    global _tracer
+    if _tracer is not None:
+        raise RuntimeError('Tracing is already on')
+    tracer = Tracer(memory)
+    started_tracemalloc = memory and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    _tracer = tracer
+    try:
+        yield tracer
+    finally:
+        _tracer = None
+        if started_tracemalloc:
+            tracemalloc.stop()
@@ -1,12 +1,16 @@
+import collections
 import datetime as dt
 import json
 import locale
+import os
+import time
+from html.parser import HTMLParser
 
-import bs4
-import requests
-import numpy as np
+import pandas as pd
 
-from covid_tools.query import load_jhu_us_cases, load_jhu_us_deaths, load_jhu_us
+from covid_tools.query import fetch_jhu, get_session, jhu_source_key
+from covid_tools.storage import read_json, write_atomic
+from covid_tools.rollup import load_rollup_cube
 from covid_tools.const import *
 
 locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
@@ -16,6 +20,11 @@ QUERY_UPDATE = 'Last_Update'
 QUERY_CONFIRMED = 'Confirmed'
 QUERY_DEATHS = 'Deaths'
 LAST_UPDATE = 'Last update'
+LIVE_TTL = 60
+PREVIOUS_DAY_JSON = os.path.join(DATA_DIR, 'jhu-us-previous-day.json')
+
+_live_cache = {}
+_previous_day = {}
 
 def US_QUERY_PARAMS():
     return {
@@ -25,58 +34,155 @@ def US_QUERY_PARAMS():
     }
 
 def get_jhu_us_aggregate(fetch=False):
-    df_jhu = load_jhu_us(fetch).groupby([DATE]).sum().reset_index()
-    return df_jhu
+    return load_rollup_cube(fetch).level(NATION).loc[:, [DATE, CASES, DEATHS]]
 
 
 def get_jhu_us_states(fetch=False):
-    df = load_jhu_us(fetch)
-    df = df.loc[~df.loc[:, STATE].isin(('Diamond Princess', 'Grand Princess'))]
-    df = df.groupby([DATE, STATE]).sum().reset_index().convert_dtypes()
-    return df
+    return load_rollup_cube(fetch).level(STATE).loc[
+        :, [DATE, STATE, CASES, DEATHS]]
+
+
+LiveTotal = collections.namedtuple(
+    'LiveTotal', ['last_update', 'confirmed', 'deaths'])
+
+
+class _FeatureTableParser(HTMLParser):
+    """Collects the label and value cells of the rows of an ftrTable"""
+
+    def __init__(self):
+        super().__init__()
+        self.fields = {}
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self._row = []
+        elif tag == 'td' and self._row is not None:
+            self._cell = []
 
+    def handle_endtag(self, tag):
+        if tag == 'td' and self._cell is not None:
+            self._row.append(''.join(self._cell).strip())
+            self._cell = None
+        elif tag == 'tr' and self._row is not None:
+            if len(self._row) == 2:
+                key, value = self._row
+                self.fields[key.rstrip(':')] = value
+            self._row = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+
+def parse_live_html(content):
+    """Parses the HTML response of the ArcGIS query into a LiveTotal.
+
+    Only the ftrTable of the page is handed to the parser.
+
+    Args:
+        content: The response body, as bytes or str.
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    table = content.find('ftrTable')
+    if table < 0:
+        raise ValueError('ArcGIS response has no ftrTable')
+    start = content.rfind('<table', 0, table)
+    end = content.find('</table>', table)
+    parser = _FeatureTableParser()
+    parser.feed(content[start:None if end < 0 else end + len('</table>')])
+    parser.close()
+    fields = parser.fields
+    last_update = (
+        dt.datetime.strptime(fields[LAST_UPDATE], '%m/%d/%Y %I:%M:%S %p')
+        + (dt.datetime.fromtimestamp(0) - dt.datetime.utcfromtimestamp(0))
+    )
+    return LiveTotal(last_update, int(fields[QUERY_CONFIRMED]),
+                     int(fields[QUERY_DEATHS]))
 
-def fetch_us_live_total(html=False):
+
+def parse_live_json(content):
+    """Parses the JSON response of the ArcGIS query into a LiveTotal.
+
+    Args:
+        content: The response body, as bytes or str.
+    """
+    attributes = json.loads(content)['features'][0]['attributes']
+    return LiveTotal(
+        dt.datetime.fromtimestamp(attributes[QUERY_UPDATE] // 1000),
+        int(attributes[QUERY_CONFIRMED]), int(attributes[QUERY_DEATHS]))
+
+
+def fetch_us_live_total(html=False, ttl=LIVE_TTL):
+    """Fetches the live US totals from the JHU ArcGIS service.
+
+    Responses are kept for ttl seconds, so that frequent polls only reach
+    the service once per ttl.
+
+    Returns:
+        A LiveTotal of the last update time and the confirmed cases and
+        deaths.
+    """
+    cached = _live_cache.get(html)
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        return cached[1]
     params = US_QUERY_PARAMS()
     params['f'] = 'html' if html else 'json'
-    r = requests.get(JHU_CSSE_NCOV_LIVE_URL, params=params)
-    if r.status_code == 200:
-        if html:
-            response = {}
-            for row in  (
-                bs4.BeautifulSoup(r.text, 'html.parser')
-                .find('table', class_='ftrTable')
-                .find_all('tr')
-            ):
-                key, value = [
-                    x.get_text(strip=True) for x in row.find_all('td')]
-                key = key.rstrip(':')
-                response[key] = value
-            response[QUERY_UPDATE] = (
-                dt.datetime.strptime(response[{LAST_UPDATE}],
-                                     '%m/%d/%Y %I:%M:%S %p')
-                + (dt.datetime.fromtimestamp(0)
-                   - dt.datetime.utcfromtimestamp(0))
-            )
-            response[QUERY_CONFIRMED] = int(response[QUERY_CONFIRMED])
-            response[QUERY_DEATHS] = int(response[QUERY_DEATHS])
-            return response
-        else:
-            response = json.loads(r.text)['features'][0]['attributes']
-            response[QUERY_UPDATE] = dt.datetime.fromtimestamp(
-                response[QUERY_UPDATE] // 1000)
-        return response
-    raise ConnectionError('ArcGIS API Retruned a Non-200 HTTP Code')
+    r = get_session().get(JHU_CSSE_NCOV_LIVE_URL, params=params)
+    if r.status_code != 200:
+        raise ConnectionError('ArcGIS API Retruned a Non-200 HTTP Code')
+    if html:
+        response = parse_live_html(r.content)
+    else:
+        response = parse_live_json(r.content)
+    _live_cache[html] = (time.monotonic(), response)
+    return response
+
+
+def _last_column_total(target_csv):
+    """Sums the last date column of a wide JHU CSV without parsing the rest"""
+    last_col = pd.read_csv(target_csv, nrows=0).columns[-1]
+    return int(pd.read_csv(target_csv, usecols=[last_col])[last_col].sum())
+
+
+def previous_day_totals(fetch=False):
+    """The US cases and deaths on the last day of the JHU time series.
+
+    The totals are kept in memory and in PREVIOUS_DAY_JSON, keyed on the
+    size and modification time of the JHU CSVs, and are only recomputed when
+    either CSV changes on disk.
+
+    Returns:
+        A dict with the Cases and Deaths totals.
+    """
+    if fetch:
+        fetch_jhu()
+    # Lists, to compare equal to the key read back from JSON
+    key = [list(x) for x in jhu_source_key()]
+    if _previous_day.get('key') != key:
+        snapshot = read_json(PREVIOUS_DAY_JSON)
+        if snapshot.get('key') != key:
+            (cases_csv, *_), (deaths_csv, *_) = key
+            snapshot = {
+                'key': key,
+                CASES: _last_column_total(cases_csv),
+                DEATHS: _last_column_total(deaths_csv),
+            }
+            write_atomic(PREVIOUS_DAY_JSON, [json.dumps(snapshot).encode()])
+        _previous_day.clear()
+        _previous_day.update(snapshot)
+    return {CASES: _previous_day[CASES], DEATHS: _previous_day[DEATHS]}
 
 
 def fetch_us_live_new(fetch=False, html=False):
-    previous_day_cases = load_jhu_us_cases(fetch, tidy=False).iloc[:,-1].sum()
-    previous_day_deaths = load_jhu_us_deaths(fetch, tidy=False).iloc[:,-1].sum()
+    previous_day = previous_day_totals(fetch)
     current = fetch_us_live_total(html)
     return {
-        LAST_UPDATE: current[QUERY_UPDATE],
-        NEW_CASES: current[QUERY_CONFIRMED] - previous_day_cases,
-        NEW_DEATHS: current[QUERY_DEATHS] - previous_day_deaths,
+        LAST_UPDATE: current.last_update,
+        NEW_CASES: current.confirmed - previous_day[CASES],
+        NEW_DEATHS: current.deaths - previous_day[DEATHS],
     }
 
 
@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+
+from covid_tools.const import *
+from covid_tools.calc import _check_tuple_param, join_populations
+from covid_tools.query import JHU_DATE_FORMAT, JHU_ID_COLUMNS
+
+
+class TimeSeriesMatrix:
+    """A dense time series with one row per location and one column per day.
+
+    The JHU time series are published in this shape, and in it the operations
+    of calc become whole-array operations: a daily change is a difference
+    along the date axis and a rolling average is a difference of cumulative
+    sums. Every method returns a new matrix with the same locations and dates.
+
+    Attributes:
+        values: A float64 array of shape (locations, dates). Missing values
+            are NaN.
+        locations: A dataframe with one row per location, such as its County
+            and State, and optionally its Population.
+        dates: A DatetimeIndex of consecutive days.
+    """
+
+    def __init__(self, values, locations, dates):
+        values = np.asarray(values, dtype='float64')
+        if values.shape != (len(locations), len(dates)):
+            raise ValueError(
+                f'Values of shape {values.shape} do not match '
+                f'{len(locations)} locations and {len(dates)} dates')
+        self.values = values
+        self.locations = locations.reset_index(drop=True)
+        self.dates = pd.DatetimeIndex(dates)
+
+    @classmethod
+    def from_jhu(cls, df):
+        """Builds a matrix from a wide JHU time series.
+
+        Args:
+            df: The untidied JHU dataframe, as returned by
+                load_jhu_us_cases(tidy=False) or load_jhu_us_deaths(tidy=False).
+        """
+        date_cols = [x for x in df.columns if x not in JHU_ID_COLUMNS]
+        locations = pd.DataFrame({
+            COUNTY: df['Admin2'].astype('category'),
+            STATE: df['Province_State'].astype('category'),
+        })
+        if POPULATION in df:
+            locations[POPULATION] = df[POPULATION].to_numpy()
+        return cls(df[date_cols].to_numpy(dtype='float64'), locations,
+                   pd.to_datetime(date_cols, format=JHU_DATE_FORMAT))
+
+    @classmethod
+    def from_tidy(cls, df, date_col, location_cols, value_col,
+                  ffill_missing=True):
+        """Builds a matrix from a tidy dataframe.
+
+        Missing days are filled forward within each location, from its first
+        to its last date, as calc.fill_missing_date_groups does. Days outside
+        of a location's span are left missing.
+
+        Args:
+            df: A tidy dataframe with at most one row per location and date.
+            date_col: The column holding the date.
+            location_cols: The column or list of columns identifying a
+                location, such as [COUNTY, STATE].
+            value_col: The column holding the values.
+        """
+        if isinstance(location_cols, str):
+            location_cols = [location_cols]
+        df = df[df[value_col].notna()]
+        codes, locations = pd.factorize(
+            pd.MultiIndex.from_frame(df[location_cols]), sort=True)
+        df_dates = pd.DatetimeIndex(df[date_col])
+        dates = pd.date_range(df_dates.min(), df_dates.max(), name=date_col)
+        values = np.full((len(locations), len(dates)), np.nan)
+        values[codes, dates.get_indexer(df_dates)] = df[value_col].to_numpy(
+            dtype='float64', na_value=np.nan)
+        if ffill_missing:
+            values = _ffill_rows(values)
+        locations = locations.to_frame(index=False)
+        locations.columns = location_cols
+        return cls(values, locations, dates)
+
+    def _like(self, values):
+        return TimeSeriesMatrix(values, self.locations, self.dates)
+
+    def daily_change(self):
+        """The change in value from the previous day"""
+        dt = np.empty_like(self.values)
+        dt[:, 0] = np.nan
+        np.subtract(self.values[:, 1:], self.values[:, :-1], out=dt[:, 1:])
+        return self._like(dt)
+
+    def rolling_avg(self, window):
+        """The mean over a trailing window of days.
+
+        Computed as the difference of cumulative sums, and missing for any
+        window containing a missing value, like pandas' rolling mean.
+        """
+        return self._like(_rolling_mean_rows(self.values, window))
+
+    def location_populations(self, population_mapper=None, group_col=None):
+        """The population of each location as an array.
+
+        Args:
+            population_mapper: None to use the Population column of the
+                locations, an array with one entry per location, or a Series,
+                dict or function mapping the values in group_col to their
+                populations, as accepted by calc.join_populations.
+            group_col: The location column which population_mapper is keyed
+                on.
+        """
+        if population_mapper is None:
+            return self.locations[POPULATION].to_numpy(dtype='float64')
+        if isinstance(population_mapper, np.ndarray):
+            return population_mapper.astype('float64')
+        return join_populations(self.locations[group_col],
+                                population_mapper)[0]
+
+    def normalize_population(self, population_mapper=None, group_col=None,
+                             norm_size=1e5):
+        """The values per norm_size people of each location"""
+        populations = self.location_populations(population_mapper, group_col)
+        return self._like(
+            self.values * (norm_size / populations)[:, np.newaxis])
+
+    def to_tidy(self, value_col, date_col=DATE, drop_missing=True):
+        """Converts the matrix to a tidy dataframe ordered by date"""
+        return matrices_to_tidy(self, {value_col: self.values}, date_col,
+                                drop_missing)
+
+    def compute_all(self, var_col, var_dt_col=None, var_dt_avg_col=None,
+                    var_norm_col=None, var_dt_norm_avg_col=None,
+                    population_mapper=None, group_col=None, avg_window=14,
+                    norm_size=1e5, date_col=DATE):
+        """Matrix counterpart of calc.compute_all for every location at once.
+
+        Column arguments are given and rounded as in calc.compute_all, and
+        only the requested columns are returned. Normalized columns need
+        either a population_mapper or a Population column in the locations.
+
+        Returns:
+            A tidy dataframe with the locations, the date, the original values
+            and the requested derived columns, ordered by date.
+        """
+        var_dt = self.daily_change()
+        var_dt_avg = var_dt.rolling_avg(avg_window)
+        derived = [(var_dt_col, None, var_dt.values),
+                   (var_dt_avg_col, 1, var_dt_avg.values)]
+        if var_norm_col is not None or var_dt_norm_avg_col is not None:
+            scale = norm_size / self.location_populations(population_mapper,
+                                                          group_col)
+            scale = scale[:, np.newaxis]
+            derived.append((var_norm_col, 1, self.values * scale))
+            derived.append((var_dt_norm_avg_col, 2, var_dt_avg.values * scale))
+
+        columns = {var_col: self.values}
+        for col, decimals, values in derived:
+            if col is None:
+                continue
+            if _check_tuple_param(col):
+                col, decimals = col
+            if decimals is not None:
+                values = np.round(values, decimals)
+            columns[col] = values.astype(DTYPES['derived'], copy=False)
+        return matrices_to_tidy(self, columns, date_col)
+
+
+def _ffill_rows(values):
+    """Fills missing values forward along each row"""
+    n_dates = values.shape[1]
+    last_valid = np.where(~np.isnan(values), np.arange(n_dates), 0)
+    np.maximum.accumulate(last_valid, axis=1, out=last_valid)
+    filled = np.take_along_axis(values, last_valid, axis=1)
+    # Leave the days after the last valid value of each row missing
+    last_seen = np.where(~np.isnan(values), np.arange(n_dates), -1).max(axis=1)
+    filled[np.arange(n_dates) > last_seen[:, np.newaxis]] = np.nan
+    return filled
+
+
+def _rolling_mean_rows(values, window):
+    """Rolling mean along each row using cumulative sums"""
+    missing = np.isnan(values)
+    sums = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(np.where(missing, 0, values), axis=1, out=sums[:, 1:])
+    counts = np.zeros(sums.shape, dtype='int64')
+    np.cumsum(missing, axis=1, out=counts[:, 1:])
+    rolling = np.full(values.shape, np.nan)
+    window_sums = sums[:, window:] - sums[:, :-window]
+    window_missing = counts[:, window:] - counts[:, :-window]
+    rolling[:, window - 1:] = np.where(window_missing == 0,
+                                       window_sums / window, np.nan)
+    return rolling
+
+
+def matrices_to_tidy(matrix, columns, date_col, drop_missing=True):
+    """Flattens matrices sharing locations and dates into a tidy dataframe.
+
+    Rows are ordered by date and then by location. If drop_missing is True,
+    rows where the first column is missing are dropped.
+
+    Args:
+        matrix: The TimeSeriesMatrix whose locations and dates label the rows.
+        columns: A dict of column names to arrays shaped like matrix.values.
+        date_col: The name of the date column.
+    """
+    n_locations, n_dates = matrix.values.shape
+    tidy = {}
+    for col in matrix.locations.columns:
+        location_values = matrix.locations[col]
+        if isinstance(location_values.dtype, pd.CategoricalDtype):
+            tidy[col] = pd.Categorical.from_codes(
+                np.tile(location_values.cat.codes.to_numpy(), n_dates),
+                location_values.cat.categories)
+        else:
+            tidy[col] = np.tile(location_values.to_numpy(), n_dates)
+    tidy[date_col] = np.repeat(matrix.dates.to_numpy(), n_locations)
+    for col, values in columns.items():
+        tidy[col] = values.ravel(order='F')
+    df = pd.DataFrame(tidy)
+    if drop_missing:
+        first_col = next(iter(columns))
+        df = df[df[first_col].notna()].reset_index(drop=True)
+    return df
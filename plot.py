@@ -1,3 +1,5 @@
+import collections
+
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
@@ -5,7 +7,8 @@ import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 
-from covid_tools.calc import fill_missing_date, fill_missing_date_groups
+from covid_tools.calc import (frame_fingerprint, fill_missing_date,
+                              fill_missing_date_groups)
 
 sns.set()
 
@@ -27,7 +30,10 @@ def basic_ts_plot(df, dep_var_col, date_col='date', plot_type='scatter'):
 
 
 def convert_to_np_nan(df):
-    return df.copy().replace({pd.NA: np.nan})
+    """Replaces pd.NA with np.nan, returning df itself if no column uses pd.NA"""
+    if not any(getattr(x, 'na_value', None) is pd.NA for x in df.dtypes):
+        return df
+    return df.replace({pd.NA: np.nan})
 
 
 def daily_and_avg_static(df, date_col, daily_change_col, rolling_avg_col, ax):
@@ -56,8 +62,152 @@ def daily_and_avg_interactive(df, date_col, daily_change_col, rolling_avg_col):
     return fig
 
 
+PAYLOAD_CACHE_SIZE = 8
+_payload_cache = collections.OrderedDict()
+
+
+def _lttb_indices(values, n_out):
+    """Picks n_out columns of each row by largest-triangle-three-buckets.
+
+    The rows share their x values, the column positions, so every row is
+    downsampled in the same pass over the buckets. Missing values are only
+    picked when a bucket has no other values.
+
+    Returns:
+        An int array of shape (rows, n_out) of increasing column indices.
+    """
+    n_rows, n = values.shape
+    if n_out >= n or n_out < 3:
+        return np.broadcast_to(np.arange(n), (n_rows, n))
+    rows = np.arange(n_rows)
+    x = np.arange(n, dtype='float64')
+    # The first and last columns are kept, the rest is split into buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int64')
+    picked = np.empty((n_rows, n_out), dtype='int64')
+    picked[:, 0] = 0
+    picked[:, -1] = n - 1
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[stop:next_stop].mean()
+        next_values = values[:, stop:next_stop]
+        next_count = (~np.isnan(next_values)).sum(axis=1)
+        next_y = np.nansum(next_values, axis=1) / np.maximum(next_count, 1)
+        prev = picked[:, i]
+        prev_x = x[prev][:, np.newaxis]
+        prev_y = values[rows, prev][:, np.newaxis]
+        area = np.abs(
+            (prev_x - next_x) * (values[:, start:stop] - prev_y)
+            - (prev_x - x[start:stop]) * (next_y[:, np.newaxis] - prev_y))
+        picked[:, i + 1] = start + np.argmax(np.nan_to_num(area, nan=-1.0),
+                                             axis=1)
+    return picked
+
+
+def _lttb_spans(values, present, n_out):
+    """Downsamples each row of values over its own span of present columns.
+
+    A row's span runs from its first to its last present column, so its first
+    and last points are always kept and its buckets only cover its own dates.
+    Rows with the same span are passed to _lttb_indices together.
+
+    Returns:
+        A list of int arrays of increasing column indices, one per row.
+    """
+    n_rows, n = present.shape
+    first = np.argmax(present, axis=1)
+    last = n - 1 - np.argmax(present[:, ::-1], axis=1)
+    picked = [np.empty(0, dtype='int64')] * n_rows
+    rows = np.flatnonzero(present.any(axis=1))
+    spans, inverse = np.unique(np.stack([first[rows], last[rows]], axis=1),
+                               axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    for i, (start, stop) in enumerate(spans):
+        span_rows = rows[inverse == i]
+        indices = start + _lttb_indices(values[span_rows, start:stop + 1],
+                                        n_out)
+        for row, row_indices in zip(span_rows, indices):
+            picked[row] = row_indices
+    return picked
+
+
+def comparative_payload(df, date_col, dep_var_raw_col, dep_var_norm_col,
+                        group_col, max_points=None):
+    """Prepares the per-group arrays of a comparative plot.
+
+    Missing dates are filled as in calc.fill_missing_date_groups. The values
+    are then laid out as a groups by dates matrix, from which each trace is
+    sliced. With max_points, every trace is downsampled to at most that many
+    points by largest-triangle-three-buckets on the normalized values, over
+    the dates from its own first to its last point.
+
+    The last PAYLOAD_CACHE_SIZE payloads are kept, keyed on the contents of
+    the plotted columns, so redrawing the same data skips all of this.
+
+    Returns:
+        A list of dicts, one per group in order of first appearance, with the
+        group 'name' and the 'x' dates, 'y' normalized values and
+        'customdata' raw values of its points.
+    """
+    columns = [date_col, group_col, dep_var_raw_col, dep_var_norm_col]
+    df = df.loc[:, columns]
+    key = (frame_fingerprint(df), tuple(columns), max_points)
+    if key in _payload_cache:
+        _payload_cache.move_to_end(key)
+        return _payload_cache[key]
+
+    df = fill_missing_date_groups(df, date_col, group_col)
+    codes, groups = pd.factorize(df[group_col])
+    dates = pd.date_range(df[date_col].min(), df[date_col].max())
+    date_codes = dates.get_indexer(df[date_col])
+    shape = (len(groups), len(dates))
+    present = np.zeros(shape, dtype=bool)
+    present[codes, date_codes] = True
+    matrices = []
+    for col in (dep_var_norm_col, dep_var_raw_col):
+        values = np.full(shape, np.nan)
+        values[codes, date_codes] = df[col].to_numpy(dtype='float64',
+                                                     na_value=np.nan)
+        matrices.append(values)
+    norm, raw = matrices
+    if max_points is not None:
+        picked = _lttb_spans(norm, present, max_points)
+    payload = []
+    for i, group in enumerate(groups):
+        if max_points is None:
+            idx = np.flatnonzero(present[i])
+        else:
+            idx = np.unique(picked[i])
+            idx = idx[present[i, idx]]
+        payload.append({'name': group, 'x': dates[idx].to_numpy(),
+                        'y': norm[i, idx], 'customdata': raw[i, idx]})
+
+    _payload_cache[key] = payload
+    if len(_payload_cache) > PAYLOAD_CACHE_SIZE:
+        _payload_cache.popitem(last=False)
+    return payload
+
+
 def comparative_interactive(df, date_col, dep_var_raw_col, dep_var_norm_col,
-                            group_col):
-    df = convert_to_np_nan(fill_missing_date_groups(df, date_col, group_col))
-    return px.line(df, x=date_col, y=dep_var_norm_col, color=group_col,
-                   hover_data=[dep_var_raw_col])
+                            group_col, max_points=None):
+    """Compares a normalized metric across groups with one WebGL trace each.
+
+    Args:
+        max_points: If given, the number of points each trace is downsampled
+            to, see comparative_payload.
+    """
+    payload = comparative_payload(df, date_col, dep_var_raw_col,
+                                  dep_var_norm_col, group_col, max_points)
+    hovertemplate = (
+        f'{group_col}=%{{fullData.name}}<br>{date_col}=%{{x}}<br>'
+        f'{dep_var_norm_col}=%{{y}}<br>{dep_var_raw_col}=%{{customdata}}'
+        '<extra></extra>')
+    fig = go.Figure(layout={'xaxis_title': date_col,
+                            'yaxis_title': dep_var_norm_col,
+                            'legend_title_text': group_col})
+    fig.add_traces([
+        go.Scattergl(x=trace['x'], y=trace['y'],
+                     customdata=trace['customdata'], name=str(trace['name']),
+                     mode='lines', hovertemplate=hovertemplate)
+        for trace in payload])
+    return fig
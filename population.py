@@ -1,10 +1,37 @@
-from covid_tools.const import STATE, POPULATION, JHU_STATE_DROP
-from covid_tools.query import load_jhu_us_deaths
+import functools
+import os.path
 
+from covid_tools.const import DATA_DIR, STATE, POPULATION, JHU_STATE_DROP
 
-STATE_POPULATIONS = (
-    load_jhu_us_deaths(tidy=False).rename(columns={'Province_State': STATE})
-    .loc[:, [STATE, POPULATION]].dropna().groupby(STATE).sum()
-    .drop(JHU_STATE_DROP).loc[:, POPULATION]
-)
-US_POPULATION = STATE_POPULATIONS.sum()
\ No newline at end of file
+STATE_POPULATIONS_CSV = os.path.join(DATA_DIR, 'state_populations.csv')
+
+
+@functools.lru_cache(maxsize=None)
+def state_populations():
+    """Population of each state, derived once from the JHU deaths series.
+
+    The table is saved to STATE_POPULATIONS_CSV the first time it is derived
+    and read back from there afterwards. Delete the file to derive it again.
+    """
+    import pandas as pd
+    if os.path.isfile(STATE_POPULATIONS_CSV):
+        return pd.read_csv(STATE_POPULATIONS_CSV,
+                           index_col=STATE).loc[:, POPULATION]
+    from covid_tools.query import load_jhu_us_deaths
+    populations = (
+        load_jhu_us_deaths(tidy=False).rename(columns={'Province_State': STATE})
+        .loc[:, [STATE, POPULATION]].dropna().groupby(STATE).sum()
+        .drop(JHU_STATE_DROP).loc[:, POPULATION]
+    )
+    populations.to_csv(STATE_POPULATIONS_CSV, header=True)
+    return populations
+
+
+def __getattr__(name):
+    # STATE_POPULATIONS and US_POPULATION are computed on first access so that
+    # importing this module does not load the JHU data.
+    if name == 'STATE_POPULATIONS':
+        return state_populations()
+    if name == 'US_POPULATION':
+        return state_populations().sum()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
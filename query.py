@@ -1,10 +1,21 @@
 import argparse
+import hashlib
+import json
 import os.path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
 from covid_tools.const import *
+from covid_tools.calc import clear_result_cache
+from covid_tools.instrument import current_stage, traced
+from covid_tools.storage import (feather, read_json, write_atomic,
+                                 write_feather_atomic)
 
 JHU_TS_BASE_URL = 'https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/'
 CTP_API = 'https://api.covidtracking.com/'
@@ -12,96 +23,620 @@ CTP_API = 'https://api.covidtracking.com/'
 JHU_US_CASES, JHU_US_DEATHS = [f'jhu-us-{x}' for x in ('cases', 'deaths')]
 CDPH_CASES, CDPH_HOSPITALS = [f'cdph-{x}' for x in ('cases', 'hospitals')]
 
-SOURCES = pd.DataFrame(
-    [
-        [
-            JHU_US_CASES,
-            JHU_TS_BASE_URL+'time_series_covid19_confirmed_US.csv',
-        ], [
-            JHU_US_DEATHS,
-            JHU_TS_BASE_URL+'time_series_covid19_deaths_US.csv',
-        ], [
-            'ctp-national',
-            CTP_API+'/v1/us/daily.csv',
-        ], [
-            CDPH_CASES,
-            'https://data.ca.gov/dataset/590188d5-8545-4c93-a9a0-e230f0db7290/resource/926fd08f-cc91-4828-af38-bd45de97f8c3/download/statewide_cases.csv'
-        ], [
-            CDPH_HOSPITALS,
-            'https://data.ca.gov/dataset/529ac907-6ba1-4cb7-9aae-8966fc96aeef/resource/42d33765-20fd-44b8-a978-b083b7542225/download/hospitals_by_county.csv',
-        ], 
-    ],
-    columns=['name', 'url']
-)
-SOURCES['csv'] = SOURCES['name'].apply(
-    lambda x: os.path.join(DATA_DIR, x+'.csv'))
-SOURCES.set_index('name', inplace=True)
-
-def fetch_source(name):
-    r = requests.get(SOURCES.loc[name].loc['url'])
-    if r.status_code == 200:
-        with open(SOURCES.loc[name].loc['csv'], 'w') as f:
-            f.write(r.text)
-    else:
-        raise ConnectionError('Non 200 HTTP Status Code')
+class Source:
+    """A CSV data source, where it is cached and how to read it.
+
+    Declaring the columns and their dtypes up front lets pandas skip type
+    inference and only parse the columns which are used.
+
+    Attributes:
+        name: The name of the source in SOURCES.
+        url: Where the CSV is downloaded from.
+        csv: The path of the cached CSV.
+        meta: The path of the JSON file holding the HTTP cache validators.
+        tidy: The path of the Feather cache of the tidied source.
+        usecols: The columns to read, a function of a column name returning
+            whether to read it, or None for every column.
+        dtype: A dict of column dtypes. Columns which are not read are
+            ignored.
+        parse_dates: The columns holding dates.
+        date_format: The strftime format of the dates in parse_dates.
+        etag: The ETag of the cached copy, once known.
+        last_modified: The Last-Modified of the cached copy, once known.
+    """
+
+    def __init__(self, name, url, usecols=None, dtype=None, parse_dates=None,
+                 date_format=None):
+        self.name = name
+        self.url = url
+        self.csv = os.path.join(DATA_DIR, name+'.csv')
+        self.meta = self.csv+'.json'
+        self.tidy = os.path.join(DATA_DIR, name+'.tidy.feather')
+        self.usecols = usecols
+        self.dtype = dtype
+        self.parse_dates = parse_dates
+        self.date_format = date_format
+        self.etag = None
+        self.last_modified = None
+
+    def __repr__(self):
+        return f'Source({self.name!r}, {self.url!r})'
+
+    @traced('read_csv')
+    def read_csv(self, path=None, **kwargs):
+        """Reads the cached CSV with the declared schema.
+
+        Keyword arguments are passed on to pd.read_csv and take precedence
+        over the declared schema. A callable usecols is resolved against the
+        header first. The pyarrow engine is used when pyarrow is installed,
+        pandas is 1.4 or later, and the read is not chunked. Before pandas
+        2.0, which added date_format, the dates are converted after reading.
+
+        Args:
+            path: The CSV to read, by default the cached copy of the source.
+        """
+        options = {'usecols': self.usecols, 'dtype': self.dtype,
+                   'parse_dates': self.parse_dates,
+                   'date_format': self.date_format}
+        options.update(kwargs)
+        options = {x: y for x, y in options.items() if y is not None}
+        path = path or self.csv
+        current_stage().record(source=self.name,
+                               bytes_read=os.path.getsize(path))
+        if callable(options.get('usecols')):
+            header = pd.read_csv(path, nrows=0).columns
+            options['usecols'] = [x for x in header if options['usecols'](x)]
+        date_cols = []
+        if _PANDAS_VERSION < (2, 0) and 'date_format' in options:
+            date_format = options.pop('date_format')
+            if not _is_chunked(options):
+                date_cols = options.pop('parse_dates', [])
+        if feather is None or not _pyarrow_can_read(options):
+            df = pd.read_csv(path, **options)
+        else:
+            # The pyarrow engine converts every column when given dtypes, so
+            # the declared dtypes are applied to their own columns afterwards.
+            # Text is already read as strings, and astype(str) would turn
+            # missing values into 'nan' before pandas 3.
+            dtype = options.pop('dtype', {})
+            df = pd.read_csv(path, engine='pyarrow', **options)
+            for col in df.columns:
+                if col in dtype and dtype[col] is not str:
+                    df[col] = df[col].astype(dtype[col])
+        for col in date_cols:
+            df[col] = pd.to_datetime(df[col], format=date_format)
+        return df
+
+
+_PANDAS_VERSION = tuple(int(x) for x in pd.__version__.split('.')[:2])
+
+
+def _is_chunked(options):
+    return any(options.get(x) not in (None, False)
+               for x in ('chunksize', 'iterator'))
+
+
+def _pyarrow_can_read(options):
+    return (_PANDAS_VERSION >= (1, 4) and not _is_chunked(options)
+            and options.get('nrows') is None)
+
+
+SOURCES = {}
+
+
+def register_source(source):
+    """Adds a Source to SOURCES, replacing any source of the same name"""
+    SOURCES[source.name] = source
+    return source
+
+
+JHU_ID_DTYPES = {
+    'UID': 'int64', 'iso2': str, 'iso3': str, 'code3': 'int64',
+    'FIPS': 'float64', 'Admin2': DTYPES['label'],
+    'Province_State': DTYPES['label'],
+    'Country_Region': str, 'Lat': 'float64', 'Long_': 'float64',
+    'Combined_Key': str, 'Population': 'int64',
+}
+
+# Only the county, state and population are used of the location columns
+JHU_UNUSED_COLUMNS = {'UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Country_Region',
+                      'Lat', 'Long_', 'Combined_Key'}
+
+
+def _jhu_usecols(col):
+    return col not in JHU_UNUSED_COLUMNS
+
+
+register_source(Source(
+    JHU_US_CASES,
+    JHU_TS_BASE_URL+'time_series_covid19_confirmed_US.csv',
+    usecols=_jhu_usecols,
+    dtype=JHU_ID_DTYPES,
+))
+register_source(Source(
+    JHU_US_DEATHS,
+    JHU_TS_BASE_URL+'time_series_covid19_deaths_US.csv',
+    usecols=_jhu_usecols,
+    dtype=JHU_ID_DTYPES,
+))
+register_source(Source(
+    'ctp-national',
+    CTP_API+'/v1/us/daily.csv',
+    parse_dates=['date'],
+    date_format='%Y%m%d',
+))
+register_source(Source(
+    CDPH_CASES,
+    'https://data.ca.gov/dataset/590188d5-8545-4c93-a9a0-e230f0db7290/resource/926fd08f-cc91-4828-af38-bd45de97f8c3/download/statewide_cases.csv'
+))
+register_source(Source(
+    CDPH_HOSPITALS,
+    'https://data.ca.gov/dataset/529ac907-6ba1-4cb7-9aae-8966fc96aeef/resource/42d33765-20fd-44b8-a978-b083b7542225/download/hospitals_by_county.csv',
+    dtype={'county': DTYPES['label']},
+    parse_dates=['todays_date'],
+    date_format='%Y-%m-%d',
+))
+
+CHUNK_SIZE = 1 << 20
+# Seconds to wait for a connection and then between bytes of a download
+FETCH_TIMEOUT = (10, 60)
+TIDY_CACHE_VERSION = 1
+CACHE_STATS = {'downloaded': 0, 'not_modified': 0, 'bytes_downloaded': 0,
+               'bytes_skipped': 0}
+
+_session = None
+_sources_lock = threading.Lock()
+
+
+def get_session():
+    """Returns the pooled HTTP session shared by every source"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(SOURCES),
+                              pool_maxsize=len(SOURCES))
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def _cache_validators(name):
+    """Returns the ETag and Last-Modified of the cached copy of a source"""
+    source = SOURCES[name]
+    if not os.path.isfile(source.csv):
+        return None, None
+    if source.etag is None and source.last_modified is None:
+        try:
+            with open(source.meta) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        with _sources_lock:
+            source.etag = meta.get('etag')
+            source.last_modified = meta.get('last_modified')
+    return source.etag, source.last_modified
+
+
+@traced('fetch_source')
+def fetch_source(name, timeout=FETCH_TIMEOUT):
+    """Downloads a source if it changed since the cached copy.
+
+    The ETag and Last-Modified headers of each download are kept with the
+    source, and later requests are made conditional on them. The body is
+    streamed to disk and atomically replaces the cached CSV.
+
+    Callers clear the results cached by calc.compute_all_groups after a
+    download, see fetch_sources.
+
+    Args:
+        name: The name of the source in SOURCES.
+        timeout: Seconds to wait for the server, either one number or a
+            (connect, read) tuple as taken by requests. A stalled download
+            raises requests.Timeout.
+    Returns:
+        True if a new copy was downloaded, False if the server reported the
+        cached copy is still current.
+    """
+    source = SOURCES[name]
+    current_stage().record(source=name)
+    etag, last_modified = _cache_validators(name)
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    with get_session().get(source.url, headers=headers, stream=True,
+                           timeout=timeout) as r:
+        if r.status_code == 304:
+            with _sources_lock:
+                CACHE_STATS['not_modified'] += 1
+                CACHE_STATS['bytes_skipped'] += os.path.getsize(source.csv)
+            current_stage().record(outcome='not modified')
+            return False
+        if r.status_code != 200:
+            raise ConnectionError('Non 200 HTTP Status Code')
+        size = write_atomic(source.csv,
+                             r.iter_content(chunk_size=CHUNK_SIZE))
+        meta = {'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified')}
+    write_atomic(source.meta, [json.dumps(meta).encode()])
+    with _sources_lock:
+        source.etag = meta['etag']
+        source.last_modified = meta['last_modified']
+        CACHE_STATS['downloaded'] += 1
+        CACHE_STATS['bytes_downloaded'] += size
+    current_stage().record(outcome='downloaded', bytes_read=size)
+    return True
+
+
+def _fetch_with_retries(name, retries, backoff, timeout):
+    """Fetches a source, retrying failures with exponential backoff"""
+    start = time.perf_counter()
+    error = None
+    for attempt in range(1, retries + 2):
+        try:
+            fetched = fetch_source(name, timeout)
+            outcome = 'downloaded' if fetched else 'not modified'
+            error = None
+            break
+        except (requests.RequestException, ConnectionError) as e:
+            outcome = 'failed'
+            error = e
+            if attempt <= retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+    return {
+        'outcome': outcome,
+        'attempts': attempt,
+        'seconds': time.perf_counter() - start,
+        'error': None if error is None else repr(error),
+    }
+
+
+def fetch_sources(names, jobs=4, retries=2, backoff=1.0,
+                  timeout=FETCH_TIMEOUT):
+    """Downloads several sources concurrently.
+
+    Args:
+        names: The names of the sources in SOURCES to download.
+        jobs: The number of downloads to run at the same time.
+        retries: How many times to retry a failed download.
+        backoff: Seconds to wait before the first retry, doubling after each
+            further failure.
+        timeout: The timeout of each request, see fetch_source. Timeouts are
+            retried like other failures.
+    Returns:
+        A dict keyed by source name, in the order of names, reporting the
+        outcome ('downloaded', 'not modified' or 'failed'), the number of
+        attempts, the wall time in seconds and any error of each source.
+    """
+    names = list(dict.fromkeys(names))
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        reports = list(executor.map(
+            lambda x: _fetch_with_retries(x, retries, backoff, timeout),
+            names))
+    # Cleared once the downloads are done, rather than from each thread
+    if any(x['outcome'] == 'downloaded' for x in reports):
+        clear_result_cache()
+    return dict(zip(names, reports))
+
+
+def _check_fetch_report(report):
+    failed = [name for name in report if report[name]['outcome'] == 'failed']
+    if failed:
+        raise ConnectionError(
+            'Failed to fetch ' + ', '.join(
+                f"{name} ({report[name]['error']})" for name in failed))
+    return report
+
+
+def _source_csv(name, fetch):
+    target_csv = SOURCES[name].csv
+    if (not os.path.isfile(target_csv) or fetch) and fetch_source(name):
+        clear_result_cache()
+    return target_csv
+
 
+@traced('load_source')
+def load_source(name, fetch, **kwargs):
+    """Reads a source with its declared schema, see Source.read_csv"""
+    current_stage().record(source=name)
+    return SOURCES[name].read_csv(_source_csv(name, fetch), **kwargs)
 
-def load_source(name, fetch):
-    target_csv = SOURCES.loc[name].loc['csv']
-    if not os.path.isfile(target_csv) or fetch:
-        fetch_source(name)
-    return pd.read_csv(target_csv)
+
+def _file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+TIDY_CACHE_STATUS = {}
+
+
+def _read_tidy_cache(target_tidy):
+    return feather.read_table(target_tidy, memory_map=True).to_pandas()
+
+
+@traced('load_tidy_source')
+def load_tidy_source(name, tidy_func, fetch=False, append_func=None,
+                     meta_func=None):
+    """Loads a tidied source through an on-disk columnar cache.
+
+    The tidy dataframe is stored in an uncompressed Feather file next to the
+    source CSV, keyed on the content hash of the CSV. A warm load memory maps
+    the Feather file instead of parsing and tidying the CSV again. The size
+    and modification time of the CSV are checked first so that the hash is
+    only computed when the CSV may have changed. Without pyarrow the CSV is
+    always parsed.
+
+    How the cache was used is recorded in TIDY_CACHE_STATUS[name] as 'hit',
+    'appended' or 'rebuilt'.
+
+    Args:
+        name: The name of the source in SOURCES.
+        tidy_func: A function converting the raw dataframe to a tidy one.
+        fetch: Whether to query the source before loading.
+        append_func: For sources which only grow, an optional function taking
+            the path of the CSV and the cache metadata when the CSV changed.
+            It returns the tidy rows which are new since the cache was
+            written, or None if older data was revised and the cache must be
+            rebuilt.
+        meta_func: An optional function of the CSV path returning extra
+            metadata to keep with the cache, for use by append_func.
+    """
+    current_stage().record(source=name)
+    target_csv = _source_csv(name, fetch)
+    if feather is None:
+        TIDY_CACHE_STATUS[name] = 'rebuilt'
+        return tidy_func(SOURCES[name].read_csv(target_csv))
+    target_tidy = SOURCES[name].tidy
+    meta_path = target_tidy + '.json'
+    meta = read_json(meta_path)
+    stat = os.stat(target_csv)
+    key = {'version': TIDY_CACHE_VERSION, 'size': stat.st_size,
+           'mtime_ns': stat.st_mtime_ns}
+    cached = (os.path.isfile(target_tidy)
+              and meta.get('version') == TIDY_CACHE_VERSION)
+    if cached:
+        if all(meta.get(x) == key[x] for x in key):
+            TIDY_CACHE_STATUS[name] = 'hit'
+            return _read_tidy_cache(target_tidy)
+        key['digest'] = _file_digest(target_csv)
+        if meta.get('digest') == key['digest']:
+            meta.update(key)
+            write_atomic(meta_path, [json.dumps(meta).encode()])
+            TIDY_CACHE_STATUS[name] = 'hit'
+            return _read_tidy_cache(target_tidy)
+
+    df_new = None
+    if cached and append_func is not None:
+        df_new = append_func(target_csv, meta)
+    if df_new is not None:
+        df = pd.concat([_read_tidy_cache(target_tidy), df_new],
+                       ignore_index=True)
+        TIDY_CACHE_STATUS[name] = 'appended'
+    else:
+        df = tidy_func(SOURCES[name].read_csv(target_csv))
+        TIDY_CACHE_STATUS[name] = 'rebuilt'
+    key['digest'] = key.get('digest') or _file_digest(target_csv)
+    if meta_func is not None:
+        key.update(meta_func(target_csv))
+    write_feather_atomic(target_tidy, df)
+    write_atomic(meta_path, [json.dumps(key).encode()])
+    return df
 
 
 def load_ctp_us(fetch=False):
     df = load_source('ctp-national', fetch)
-    df.loc[:, DATE] = pd.to_datetime(df.loc[:, DATE].apply(str))
+    df.rename(columns={'date': DATE}, inplace=True)
     df.drop(columns=['dateChecked','lastModified','hash'], inplace=True)
     df.sort_values(DATE, inplace=True)
     df.reset_index(drop=True, inplace=True)
     return df
 
 
+JHU_ID_COLUMNS = [
+    'UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State',
+    'Country_Region', 'Lat', 'Long_', 'Combined_Key', 'Population']
+JHU_DATE_FORMAT = '%m/%d/%y'
+
+
+def _repeat_categorical(values, repeats):
+    """Tiles a column as categorical codes rather than as objects"""
+    codes, categories = pd.factorize(values, sort=True)
+    codes = codes.astype('int32')
+    return pd.Categorical.from_codes(np.tile(codes, repeats), categories)
+
+
+@traced('tidy_jhu')
 def tidy_jhu(df, value_col):
-    df.drop(columns=[
-        'UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Country_Region',
-        'Lat', 'Long_', 'Combined_Key'], inplace=True)
-    df.rename(columns={'Admin2': COUNTY, 'Province_State': STATE}, inplace=True)
-    df = df.melt((COUNTY, STATE), var_name=DATE, value_name=value_col)
-    df.loc[:, DATE] = pd.to_datetime(df.loc[:, DATE])
-    df = df.convert_dtypes()
-    # df = df.sort_values(['date', 'state', 'county'])
-    return df #.reset_index(drop=True)
+    """Converts a wide JHU time series to a tidy dataframe.
+
+    Instead of melting, the date header is parsed once and the block of values
+    is taken as a single array and flattened in date order. County and State
+    are repeated as categorical codes. Rows come out in the same order as a
+    melt, all locations for the first date, then the second, and so on.
+    """
+    date_cols = [x for x in df.columns if x not in JHU_ID_COLUMNS]
+    dates = pd.to_datetime(date_cols, format=JHU_DATE_FORMAT)
+    values = df[date_cols].to_numpy()
+    n_locations, n_dates = values.shape
+    values = values.ravel(order='F')
+    # Counts with gaps stay float64 with NaN rather than a nullable type
+    if (np.issubdtype(values.dtype, np.integer)
+            or not np.isnan(values).any()):
+        values = values.astype(DTYPES['count'])
+    return pd.DataFrame({
+        COUNTY: _repeat_categorical(df['Admin2'], n_dates),
+        STATE: _repeat_categorical(df['Province_State'], n_dates),
+        DATE: np.repeat(dates.to_numpy(), n_locations),
+        value_col: values,
+    })
+
+
+def _jhu_date_columns(target_csv):
+    header = pd.read_csv(target_csv, nrows=0).columns
+    return [x for x in header if x not in JHU_ID_COLUMNS]
+
+
+def _jhu_rows_digest(target_csv, n_trailing=0):
+    """Hashes a JHU CSV, ignoring its last n_trailing date columns.
+
+    The date columns come last and hold only numbers, so trailing fields can
+    be split off each line without parsing the CSV.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(target_csv, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            if n_trailing:
+                line = line.rsplit(b',', n_trailing)[0]
+            digest.update(line + b'\n')
+    return digest.hexdigest()
+
+
+def _jhu_cache_meta(target_csv):
+    return {'n_dates': len(_jhu_date_columns(target_csv)),
+            'rows_digest': _jhu_rows_digest(target_csv)}
+
+
+def _jhu_append_func(name, value_col):
+    """Builds an append_func for load_tidy_source for a JHU time series.
+
+    JHU adds a date column every day. When everything but the new columns is
+    unchanged, only the new columns are read and tidied. Any revision to an
+    earlier column, or a change in locations, forces a full rebuild.
+    """
+    def append_new_dates(target_csv, meta):
+        date_cols = _jhu_date_columns(target_csv)
+        n_new = len(date_cols) - meta.get('n_dates', len(date_cols))
+        if n_new <= 0 or (_jhu_rows_digest(target_csv, n_new)
+                          != meta.get('rows_digest')):
+            return None
+        df = SOURCES[name].read_csv(
+            target_csv,
+            usecols=['Admin2', 'Province_State'] + date_cols[-n_new:])
+        return tidy_jhu(df, value_col)
+    return append_new_dates
 
 
 def load_jhu_us_cases(fetch=False, tidy=True):
-    df = load_source(JHU_US_CASES, fetch)
-    return tidy_jhu(df, CASES) if tidy else df
+    if tidy:
+        return load_tidy_source(JHU_US_CASES, lambda x: tidy_jhu(x, CASES),
+                                fetch, _jhu_append_func(JHU_US_CASES, CASES),
+                                _jhu_cache_meta)
+    return load_source(JHU_US_CASES, fetch)
 
 
 def load_jhu_us_deaths(fetch=False, tidy=True):
-    df = load_source(JHU_US_DEATHS, fetch)
-    return tidy_jhu(df.drop(columns='Population'), DEATHS) if tidy else df
+    if tidy:
+        return load_tidy_source(JHU_US_DEATHS, lambda x: tidy_jhu(x, DEATHS),
+                                fetch, _jhu_append_func(JHU_US_DEATHS, DEATHS),
+                                _jhu_cache_meta)
+    return load_source(JHU_US_DEATHS, fetch)
+
+
+def _same_rows(df_left, df_right, columns):
+    return len(df_left) == len(df_right) and all(
+        df_left[x].equals(df_right[x]) for x in columns)
+
+
+def fetch_jhu():
+    """Downloads the JHU US cases and deaths, raising if either fails"""
+    return _check_fetch_report(fetch_sources([JHU_US_CASES, JHU_US_DEATHS]))
+
+
+def jhu_source_key():
+    """The path, size and modification time of the JHU US cases and deaths.
 
+    Results derived from the two CSVs can be cached on this key, which
+    changes whenever either CSV changes on disk. Missing CSVs are downloaded
+    first.
+    """
+    key = []
+    for name in (JHU_US_CASES, JHU_US_DEATHS):
+        target_csv = _source_csv(name, False)
+        stat = os.stat(target_csv)
+        key.append((target_csv, stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
 
+
+@traced('load_jhu_us')
 def load_jhu_us(fetch=False):
-    return pd.merge(load_jhu_us_cases(fetch), load_jhu_us_deaths(fetch),
-                    on=[DATE, STATE, COUNTY])
+    """Loads JHU cases and deaths for every US location.
+
+    Both time series share the same locations and dates, so the deaths are
+    aligned to the cases by position. The frames are only merged on their keys
+    when the rows do not line up.
+    """
+    if fetch:
+        fetch_jhu()
+    df_cases, df_deaths = load_jhu_us_cases(), load_jhu_us_deaths()
+    if _same_rows(df_cases, df_deaths, [DATE, STATE, COUNTY]):
+        df_cases[DEATHS] = df_deaths[DEATHS].array
+        return df_cases
+    return pd.merge(df_cases, df_deaths, on=[DATE, STATE, COUNTY])
+
+
+def iter_jhu_source(name, value_col, chunk_rows=500, fetch=False):
+    """Yields a JHU time series as tidy chunks of chunk_rows locations.
+
+    The CSV is read and tidied one block of locations at a time, so memory
+    use is proportional to chunk_rows times the number of dates rather than
+    to the whole file. For the US counties with about 1,100 dates, a chunk of
+    500 locations peaks at roughly 50 MB including the raw block, against
+    several hundred MB for a full load. Each chunk has its own categories for
+    County and State.
+
+    Args:
+        name: JHU_US_CASES or JHU_US_DEATHS.
+        value_col: The name of the value column in the tidy chunks.
+        chunk_rows: The number of locations in each chunk.
+        fetch: Whether to query the source before loading.
+    """
+    reader = load_source(name, fetch, chunksize=chunk_rows)
+    for df in reader:
+        yield tidy_jhu(df, value_col)
+
+
+def iter_jhu_us(chunk_rows=500, fetch=False):
+    """Yields JHU cases and deaths as tidy chunks of chunk_rows locations.
+
+    The streaming counterpart of load_jhu_us, with the same memory bound as
+    iter_jhu_source for each of the two series.
+    """
+    if fetch:
+        fetch_jhu()
+    for df_cases, df_deaths in zip(
+            iter_jhu_source(JHU_US_CASES, CASES, chunk_rows),
+            iter_jhu_source(JHU_US_DEATHS, DEATHS, chunk_rows)):
+        if _same_rows(df_cases, df_deaths, [DATE, STATE, COUNTY]):
+            df_cases[DEATHS] = df_deaths[DEATHS].array
+            yield df_cases
+        else:
+            yield pd.merge(df_cases, df_deaths, on=[DATE, STATE, COUNTY])
 
 
 def load_cdph_hospitals(fetch=False):
     df = load_source(CDPH_HOSPITALS, fetch)
-    df['todays_date'] = pd.to_datetime(df['todays_date'])
-    return df.rename(columns={'todays_date': DATE, 'county': COUNTY}).copy()
+    return df.rename(columns={'todays_date': DATE, 'county': COUNTY})
 
 
 def load_cdph_cases(fetch=False):
     return load_source(CDPH_CASES, fetch)
 
 
-def fetch_all():
-    load_ctp_us(True)
-    load_jhu_us(True)
+SOURCE_GROUPS = {
+    CTP: ['ctp-national'],
+    JHU: [JHU_US_CASES, JHU_US_DEATHS],
+    ALL: ['ctp-national', JHU_US_CASES, JHU_US_DEATHS],
+}
+
+
+def fetch_all(jobs=4, retries=2, backoff=1.0, timeout=FETCH_TIMEOUT):
+    return _check_fetch_report(
+        fetch_sources(SOURCE_GROUPS[ALL], jobs, retries, backoff, timeout))
 
 
 # def fetch_national():
@@ -121,14 +656,29 @@ def fetch_all():
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('-g', '--get', type=str, choices=[CTP, JHU, ALL],
-                        help='Data source to query')
+    parser.add_argument('-g', '--get', type=str, nargs='+',
+                        choices=list(SOURCE_GROUPS) + list(SOURCES),
+                        help='Data sources to query')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of sources to download concurrently')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Number of retries for a failed download')
+    parser.add_argument('--timeout', type=float, nargs='+',
+                        default=FETCH_TIMEOUT, metavar='SECONDS',
+                        help='Seconds to wait for the server, or separate '
+                             'connect and read timeouts')
     args = parser.parse_args()
-    if args.get == CTP or args.get == ALL:
-        load_ctp_us(True)
-        print('Queried COVID Tracking Project - Historic US values')
-    if args.get == JHU or args.get == ALL:
-        load_jhu_us_cases(True, False)
-        print('Queried Johns Hopkins University - US cases time series')
-        load_jhu_us_deaths(True, False)
-        print('Queried Johns Hopkins University - US deaths time series')
+    if len(args.timeout) > 2:
+        parser.error('--timeout takes one or two values')
+    if args.get:
+        names = []
+        for x in args.get:
+            names.extend(SOURCE_GROUPS.get(x, [x]))
+        timeout = (args.timeout[0] if len(args.timeout) == 1
+                   else tuple(args.timeout))
+        report = fetch_sources(names, args.jobs, args.retries,
+                               timeout=timeout)
+        for name, result in report.items():
+            print(f"{name}: {result['outcome']} in {result['seconds']:.1f}s "
+                  f"after {result['attempts']} attempt(s)"
+                  + (f" - {result['error']}" if result['error'] else ''))
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+from covid_tools.const import *
+from covid_tools.california import CA_REGIONS
+from covid_tools.matrix import TimeSeriesMatrix, matrices_to_tidy
+from covid_tools.query import (fetch_jhu, jhu_source_key, load_jhu_us_cases,
+                               load_jhu_us_deaths)
+
+LEVELS = (COUNTY, REGION, STATE, NATION)
+US = 'US'
+CALIFORNIA = 'California'
+
+
+def _aggregate_rows(values, codes, n_groups):
+    """Sums the rows of values sharing a group code in a single pass.
+
+    Rows with a code of -1 belong to no group. Every code from 0 to
+    n_groups - 1 must have at least one row.
+    """
+    member = codes >= 0
+    order = np.argsort(codes[member], kind='stable')
+    rows = values[member][order]
+    if not len(rows):
+        return np.zeros((0,) + values.shape[1:])
+    starts = np.searchsorted(codes[member][order], np.arange(n_groups))
+    return np.add.reduceat(rows, starts, axis=0)
+
+
+class RollupCube:
+    """JHU cases and deaths aggregated to every level of the US hierarchy.
+
+    County data is rolled up into California regions, states and the nation
+    once, using an integer group code for each county at each level. Every
+    level keeps its populations and its tidy dataframe is built on first
+    request and then cached, so per-100k metrics at any level are a lookup.
+
+    The state level leaves out JHU_STATE_DROP, while the nation includes every
+    location, matching get_jhu_us_states and get_jhu_us_aggregate.
+    """
+
+    def __init__(self, cases, deaths, norm_size=1e5):
+        """
+        Args:
+            cases: A TimeSeriesMatrix of cumulative cases per county.
+            deaths: A TimeSeriesMatrix of cumulative deaths with the same
+                locations and dates, whose locations hold a Population column.
+            norm_size: The population size of normalized metrics.
+        """
+        locations = deaths.locations
+        self.dates = cases.dates
+        self.norm_size = norm_size
+        states = locations[STATE].astype(object)
+        counties = locations[COUNTY].astype(object)
+        memberships = {
+            REGION: counties.map(CA_REGIONS).where(states == CALIFORNIA),
+            STATE: states.where(~states.isin(JHU_STATE_DROP)),
+            NATION: pd.Series(US, index=locations.index),
+        }
+        populations = locations[POPULATION].to_numpy(dtype='float64')
+        self._levels = {COUNTY: (
+            locations.loc[:, [COUNTY, STATE]].assign(**{
+                POPULATION: populations}),
+            cases.values, deaths.values)}
+        for level, labels in memberships.items():
+            codes, groups = pd.factorize(labels, sort=True)
+            level_locations = pd.DataFrame({
+                level: pd.Categorical.from_codes(np.arange(len(groups)),
+                                                 groups),
+                POPULATION: _aggregate_rows(populations, codes, len(groups)),
+            })
+            self._levels[level] = (
+                level_locations,
+                _aggregate_rows(cases.values, codes, len(groups)),
+                _aggregate_rows(deaths.values, codes, len(groups)),
+            )
+        self._tidy = {}
+
+    @classmethod
+    def from_jhu(cls, df_cases, df_deaths, norm_size=1e5):
+        """Builds the cube from the wide JHU cases and deaths dataframes"""
+        return cls(TimeSeriesMatrix.from_jhu(df_cases),
+                   TimeSeriesMatrix.from_jhu(df_deaths), norm_size)
+
+    def populations(self, level):
+        """Population of each group at a level, indexed by group"""
+        locations = self._levels[level][0]
+        return locations.set_index(list(locations.columns[:-1]))[POPULATION]
+
+    def level(self, level):
+        """Tidy cases, deaths and per-100k metrics for a level.
+
+        Args:
+            level: One of COUNTY, REGION, STATE or NATION.
+        Returns:
+            A dataframe ordered by date and group, with the group columns,
+            the date, Cases, Deaths, Population, Cases per 100k and Deaths per
+            100k. The same dataframe is returned on every call, so copy it
+            before modifying it.
+        """
+        if level not in self._tidy:
+            locations, cases, deaths = self._levels[level]
+            scale = np.full(len(locations), np.nan)
+            populations = locations[POPULATION].to_numpy()
+            np.divide(self.norm_size, populations, out=scale,
+                      where=populations > 0)
+            scale = scale[:, np.newaxis]
+            matrix = TimeSeriesMatrix(cases, locations, self.dates)
+            df = matrices_to_tidy(matrix, {
+                CASES: cases, DEATHS: deaths,
+                CASES_NORM: (cases * scale).astype(DTYPES['derived']),
+                DEATHS_NORM: (deaths * scale).astype(DTYPES['derived']),
+            }, DATE)
+            columns = [x for x in locations.columns if x != POPULATION]
+            columns += [DATE, CASES, DEATHS, POPULATION, CASES_NORM,
+                        DEATHS_NORM]
+            self._tidy[level] = df.loc[:, columns].astype(
+                {CASES: DTYPES['count'], DEATHS: DTYPES['count']})
+        return self._tidy[level]
+
+
+_cube_cache = {}
+
+
+def load_rollup_cube(fetch=False):
+    """Loads the rollup cube of the JHU US data.
+
+    The cube is kept in memory and only rebuilt when either JHU CSV changes
+    on disk.
+    """
+    if fetch:
+        fetch_jhu()
+    key = jhu_source_key()
+    if key not in _cube_cache:
+        cube = RollupCube.from_jhu(load_jhu_us_cases(tidy=False),
+                                   load_jhu_us_deaths(tidy=False))
+        _cube_cache.clear()
+        _cube_cache[key] = cube
+    return _cube_cache[key]
@@ -0,0 +1,55 @@
+"""Atomic writes of the files cached on disk.
+
+Each file is written to a temporary file in the same directory, which then
+replaces the target, so readers never see a partly written file.
+"""
+import json
+import os
+import tempfile
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+
+def _replace_atomic(path, write):
+    """Calls write with a temporary path, then moves that file to path"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                     suffix='.part')
+    try:
+        result = write(fd, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return result
+
+
+def write_atomic(path, chunks):
+    """Streams chunks of bytes to path, returning the number of bytes"""
+    def write(fd, temp_path):
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        return size
+    return _replace_atomic(path, write)
+
+
+def write_feather_atomic(path, df):
+    """Writes a dataframe to path as an uncompressed Feather file"""
+    def write(fd, temp_path):
+        os.close(fd)
+        feather.write_feather(df, temp_path, compression='uncompressed')
+    _replace_atomic(path, write)
+
+
+def read_json(path):
+    """Reads a JSON file, or an empty dict if it is missing or invalid"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
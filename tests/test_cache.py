@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from covid_tools import calc
+
+DATE, VALUE, GROUP = 'Date', 'Cases', 'County'
+ARGS = (DATE, VALUE, GROUP, 'dt', 'avg')
+
+
+@pytest.fixture(autouse=True)
+def result_cache(monkeypatch):
+    monkeypatch.setattr(calc, 'RESULT_CACHE_DIR', None)
+    calc.clear_result_cache()
+    yield
+    calc.clear_result_cache()
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2020-03-01', periods=200)
+    return pd.concat([pd.DataFrame({
+        DATE: dates, GROUP: f'c{i}',
+        VALUE: np.cumsum(rng.integers(0, 50, len(dates)))})
+        for i in range(100)], ignore_index=True)
+
+
+def test_repeat_call_hits(df):
+    first = calc.compute_all_groups(df, *ARGS, cache=True)
+    second = calc.compute_all_groups(df, *ARGS, cache=True)
+    pd.testing.assert_frame_equal(first, second)
+    assert calc.RESULT_CACHE_STATS['hits'] >= 1
+
+
+@pytest.mark.parametrize('rows', [[0], [5, 9, 13]])
+def test_edit_in_place_misses(df, rows):
+    calc.compute_all_groups(df, *ARGS, cache=True)
+    df.loc[rows, VALUE] = -999
+    hits = calc.RESULT_CACHE_STATS['hits']
+    result = calc.compute_all_groups(df, *ARGS, cache=True)
+    assert calc.RESULT_CACHE_STATS['hits'] == hits
+    pd.testing.assert_frame_equal(result, calc.compute_all_groups(df, *ARGS))
+
+
+def test_trust_identity_reuses_fingerprint(df):
+    fingerprint = calc.frame_fingerprint(df, trust_identity=True)
+    assert calc.frame_fingerprint(df, trust_identity=True) == fingerprint
+    assert calc.frame_fingerprint(df) == fingerprint
+    df.loc[0, VALUE] = -999
+    assert calc.frame_fingerprint(df) != fingerprint
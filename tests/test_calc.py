@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from covid_tools import calc, instrument
+
+DATE, VALUE, GROUP = 'Date', 'Cases', 'County'
+DERIVED = ('dt', 'avg', 'norm', 'navg')
+# Group b has no population
+POPULATIONS = {'a': 1e5}
+
+
+@pytest.fixture
+def df():
+    dates = pd.date_range('2020-03-01', periods=30)
+    return pd.concat([pd.DataFrame({DATE: dates, GROUP: group,
+                                    VALUE: np.arange(len(dates)) * 10})
+                      for group in ('a', 'b')], ignore_index=True)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'fused': True}, {'cache': True}])
+@pytest.mark.parametrize('traced', [False, True])
+def test_missing_population_warns_at_caller(df, kwargs, traced):
+    calc.clear_result_cache(disk=False)
+    with pytest.warns(UserWarning, match='No population') as record:
+        if traced:
+            with instrument.tracing():
+                calc.compute_all_groups(df, DATE, VALUE, GROUP, *DERIVED,
+                                        POPULATIONS, **kwargs)
+        else:
+            calc.compute_all_groups(df, DATE, VALUE, GROUP, *DERIVED,
+                                    POPULATIONS, **kwargs)
+    assert record[0].filename == __file__
+
+
+def test_missing_population_warns_at_caller_of_state(df):
+    state = calc.GroupRollingState(DATE, VALUE, GROUP, *DERIVED, POPULATIONS,
+                                   avg_window=7)
+    with pytest.warns(UserWarning, match='No population') as record:
+        state.update(df)
+    assert record[0].filename == __file__
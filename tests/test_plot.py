@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+for module in ('matplotlib', 'seaborn', 'plotly'):
+    pytest.importorskip(module)
+
+from covid_tools import plot
+
+DATES = pd.date_range('2020-01-01', periods=300)
+# The first and last date of each group, some inside the shared range
+SPANS = {'a': (0, 300), 'b': (10, 300), 'c': (0, 250), 'd': (37, 211)}
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    return pd.concat([pd.DataFrame({
+        'Date': DATES[start:stop], 'County': name,
+        'Cases': rng.integers(0, 100, stop - start),
+        'Norm': rng.random(stop - start)})
+        for name, (start, stop) in SPANS.items()], ignore_index=True)
+
+
+@pytest.mark.parametrize('max_points', [50, 100])
+def test_downsampled_traces_keep_their_own_span(df, max_points):
+    plot._payload_cache.clear()
+    payload = plot.comparative_payload(df, 'Date', 'Cases', 'Norm', 'County',
+                                       max_points)
+    for trace in payload:
+        start, stop = SPANS[trace['name']]
+        assert len(trace['x']) == max_points
+        assert trace['x'][0] == DATES[start]
+        assert trace['x'][-1] == DATES[stop - 1]
+        assert not np.isnan(trace['y']).any()
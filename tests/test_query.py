@@ -0,0 +1,46 @@
+import socket
+
+import pytest
+
+from covid_tools import bench, query
+from covid_tools.const import *
+
+
+@pytest.mark.parametrize('pyarrow', [True, False])
+def test_blank_admin2_stays_missing(tmp_path, monkeypatch, pyarrow):
+    if not pyarrow:
+        monkeypatch.setattr(query, 'feather', None)
+    elif query.feather is None:
+        pytest.skip('pyarrow is not installed')
+    wide = bench.synthetic_jhu(n_states=2, n_counties=3, n_days=5)
+    # Territories and cruise ships have no county
+    wide.loc[[0, 4], 'Admin2'] = None
+    path = tmp_path / 'cases.csv'
+    wide.to_csv(path, index=False)
+
+    df = query.SOURCES[query.JHU_US_CASES].read_csv(str(path))
+    assert df['Admin2'].isna().sum() == 2
+    assert df['Province_State'].dtype == DTYPES['label']
+    tidy = query.tidy_jhu(df, CASES)
+    assert tidy[COUNTY].isna().sum() == 2 * 5
+    assert not tidy[COUNTY].cat.categories.isin(['nan', 'None']).any()
+
+
+def test_stalled_download_times_out_and_retries(tmp_path, monkeypatch):
+    # A server which accepts connections but never answers
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    url = f'http://127.0.0.1:{server.getsockname()[1]}/'
+    source = query.Source('stalled', url)
+    source.csv = str(tmp_path / 'stalled.csv')
+    source.meta = source.csv + '.json'
+    monkeypatch.setitem(query.SOURCES, source.name, source)
+    try:
+        report = query.fetch_sources([source.name], retries=1, backoff=0,
+                                     timeout=0.2)
+    finally:
+        server.close()
+    assert report[source.name]['outcome'] == 'failed'
+    assert report[source.name]['attempts'] == 2
+    assert 'Timeout' in report[source.name]['error']
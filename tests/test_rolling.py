@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from covid_tools import calc
+
+DATE, VALUE, GROUP = 'Date', 'Cases', 'County'
+DERIVED = ('dt', 'avg', 'norm', 'navg')
+WINDOW = 7
+
+
+def _series(dtype, seed=0):
+    """A cumulative series with skipped days and, for floats, missing values"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-03-01', periods=60)
+    values = np.cumsum(rng.integers(0, 50, len(dates))).astype(dtype)
+    df = pd.DataFrame({DATE: dates, VALUE: values})
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        df.loc[[12, 30, 31], VALUE] = np.nan
+    return df.drop(index=[5, 20, 21, 22, 40]).reset_index(drop=True)
+
+
+def _groups(dtype):
+    return pd.concat([_series(dtype, seed).assign(**{GROUP: f'c{seed}'})
+                      for seed in range(3)], ignore_index=True)
+
+
+@pytest.mark.parametrize('dtype', ['int32', 'float64'])
+@pytest.mark.parametrize('ffill_missing', [True, False])
+def test_rolling_state_matches_rolling_avg(dtype, ffill_missing):
+    df = _series(dtype)
+    expected = calc.daily_change(df, DATE, VALUE, 'dt', ffill_missing)
+    expected = calc.rolling_avg(expected, None, 'dt', 'avg', WINDOW)
+    expected = expected.set_index(DATE).loc[df[DATE]]
+
+    state = calc.RollingState(WINDOW, ffill_missing)
+    dt, avg = np.array([state.update(date, value) for date, value in
+                        zip(df[DATE], df[VALUE])]).T
+    np.testing.assert_allclose(dt, expected['dt'].astype('float64'))
+    np.testing.assert_allclose(avg, expected['avg'])
+
+
+@pytest.mark.parametrize('dtype', ['int32', 'float64'])
+@pytest.mark.parametrize('ffill_missing', [True, False])
+def test_group_rolling_state_matches_compute_all_groups(dtype, ffill_missing):
+    df = _groups(dtype)
+    populations = {'c0': 1e4, 'c1': 2e5, 'c2': 3e6}
+    args = (DATE, VALUE, GROUP) + DERIVED + (populations, WINDOW)
+    kwargs = {'ffill_missing': ffill_missing}
+    expected = calc.compute_all_groups(df, *args, **kwargs)
+
+    split = pd.Timestamp('2020-04-15')
+    rolling = calc.GroupRollingState.from_history(df[df[DATE] < split], *args,
+                                                  **kwargs)
+    updated = []
+    for date, df_day in df[df[DATE] >= split].groupby(DATE):
+        rolling = calc.GroupRollingState.from_dict(rolling.to_dict(),
+                                                   populations)
+        updated.append(rolling.update(df_day))
+    updated = pd.concat(updated).set_index([GROUP, DATE]).sort_index()
+
+    expected = expected.astype({GROUP: object}).set_index([GROUP, DATE])
+    expected = expected.loc[updated.index]
+    for col in DERIVED:
+        np.testing.assert_allclose(updated[col].astype('float64'),
+                                   expected[col].astype('float64'),
+                                   err_msg=col)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from covid_tools import bench, calc, query
+from covid_tools.const import *
+from covid_tools.rollup import LEVELS, RollupCube
+
+DERIVED = (NEW_CASES, NEW_CASES_AVG, CASES_NORM, NEW_CASES_AVG_NORM)
+
+
+@pytest.fixture(scope='module')
+def wide():
+    return (bench.synthetic_jhu(n_states=4, n_counties=20, n_days=100),
+            bench.synthetic_jhu(n_states=4, n_counties=20, n_days=100,
+                                deaths=True))
+
+
+@pytest.fixture(scope='module')
+def tidy(wide, tmp_path_factory):
+    directory = tmp_path_factory.mktemp('jhu')
+    bench.write_synthetic_jhu(str(directory), n_states=4, n_counties=20,
+                              n_days=100)
+    with bench.synthetic_sources(str(directory)):
+        return query.load_jhu_us()
+
+
+@pytest.fixture(params=['float64', 'float32'])
+def derived_dtype(request):
+    saved = DTYPES['derived']
+    DTYPES['derived'] = request.param
+    yield request.param
+    DTYPES['derived'] = saved
+
+
+def _assert_dtypes(df, expected):
+    for col, dtype in expected.items():
+        assert df[col].dtype == dtype, f'{col} is {df[col].dtype}'
+
+
+def test_tidy_jhu(wide):
+    df = query.tidy_jhu(wide[0], CASES)
+    _assert_dtypes(df, {COUNTY: DTYPES['label'], STATE: DTYPES['label'],
+                        CASES: DTYPES['count']})
+
+
+def test_load_jhu_us(tidy):
+    _assert_dtypes(tidy, {COUNTY: DTYPES['label'], STATE: DTYPES['label'],
+                          CASES: DTYPES['count'], DEATHS: DTYPES['count']})
+    # Two category codes, the date and two int32 counts
+    assert tidy.memory_usage(index=False).sum() <= 19 * len(tidy)
+
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_compute_all_groups(tidy, derived_dtype, fused):
+    # Drop days so that filling them has to restore the int32 counts
+    df = tidy[tidy[DATE].dt.day != 10]
+    populations = dict.fromkeys(df[COUNTY].cat.categories, 1e5)
+    df = calc.compute_all_groups(df, DATE, CASES, COUNTY, *DERIVED,
+                                 populations, fused=fused)
+    expected = {COUNTY: DTYPES['label'], STATE: DTYPES['label'],
+                CASES: DTYPES['count'], DEATHS: DTYPES['count']}
+    expected.update(dict.fromkeys(DERIVED, derived_dtype))
+    _assert_dtypes(df, expected)
+    derived_bytes = df.loc[:, list(DERIVED)].memory_usage(index=False).sum()
+    itemsize = np.dtype(derived_dtype).itemsize
+    assert derived_bytes == len(DERIVED) * itemsize * len(df)
+
+
+@pytest.mark.parametrize('level', LEVELS)
+def test_rollup_cube_level(wide, derived_dtype, level):
+    df = RollupCube.from_jhu(*wide).level(level)
+    _assert_dtypes(df, {level: DTYPES['label'], CASES: DTYPES['count'],
+                        DEATHS: DTYPES['count'], CASES_NORM: derived_dtype,
+                        DEATHS_NORM: derived_dtype})